@@ -1,13 +1,18 @@
 from __future__ import annotations
 
-from litestar import Litestar, get
+from litestar import Litestar, MediaType, Response, get, status_codes
 from litestar.plugins.sqlalchemy import SQLAlchemyPlugin
 from saq import Queue
 
-from config import CORS_CONFIG, DB_CONFIG, OPENAPI_CONFIG, SAQ, exception_handler
+from config import CORS_CONFIG, DB_CONFIG, METRICS_ENABLED, OPENAPI_CONFIG, SAQ, exception_handler
 from controllers.agent import AgentController
 from controllers.job import JobController
 from controllers.job_application import JobApplicationController
+from controllers.llm_call import LLMCallController
+from utils.ledger import flush_llm_ledger
+from utils.llm import clear_context_cache
+from utils.metrics import CONTENT_TYPE, render_metrics
+from utils.storage import start_storage_client
 
 
 @get("/health-check", sync_to_thread=False)
@@ -15,17 +20,33 @@ def index() -> str:
     return "OK"
 
 
+@get("/metrics", sync_to_thread=True, include_in_schema=False)
+def metrics() -> Response:
+    if not METRICS_ENABLED:
+        return Response(
+            status_code=status_codes.HTTP_404_NOT_FOUND,
+            media_type=MediaType.JSON,
+            content={"status": "error", "message": "Metrics are disabled"},
+        )
+
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE)
+
+
 app = Litestar(
     route_handlers=[
         index,
+        metrics,
         AgentController,
         JobApplicationController,
         JobController,
+        LLMCallController,
     ],
     cors_config=CORS_CONFIG,
     openapi_config=OPENAPI_CONFIG,
     plugins=[SQLAlchemyPlugin(DB_CONFIG), SAQ],
     exception_handlers={Exception: exception_handler},
+    on_startup=[start_storage_client],
+    on_shutdown=[clear_context_cache, flush_llm_ledger],
     signature_types=[Queue],
     debug=True,
 )
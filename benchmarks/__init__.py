@@ -0,0 +1 @@
+"""Benchmarks that run the pipeline against local fakes."""
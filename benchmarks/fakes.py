@@ -0,0 +1,88 @@
+import asyncio
+import hashlib
+import random
+import time
+
+import pymupdf
+
+from models import EMBEDDING_DIMENSIONS
+
+SKILLS = ["Python", "Django", "FastAPI", "React", "TypeScript", "AWS", "Docker", "Kubernetes", "Postgres", "Go"]
+
+
+def candidate_text(seed: str, lines: int) -> str:
+    rng = random.Random(seed)  # noqa: S311
+    return "\n".join(
+        f"{rng.choice(SKILLS)} project {index}: built and maintained services with {', '.join(rng.sample(SKILLS, 3))}"
+        for index in range(lines)
+    )
+
+
+def build_resume_pdf(seed: str, pages: int) -> bytes:
+    with pymupdf.open() as document:
+        for page_index in range(pages):
+            page = document.new_page()
+            page.insert_text((72, 72), candidate_text(f"{seed}:{page_index}", 40), fontsize=8)  # type: ignore
+        return document.tobytes()  # type: ignore
+
+
+class FakeBlob:
+    def __init__(self, name: str, pages: int, latency: float) -> None:  # noqa: D107
+        self.name = name
+        self.generation = 1
+        self.latency = latency
+        self.stream = build_resume_pdf(name, pages)
+        self.size = len(self.stream)
+        self.md5_hash = hashlib.md5(self.stream).hexdigest()  # noqa: S324
+
+    def download_as_bytes(self) -> bytes:
+        time.sleep(self.latency)
+        return self.stream
+
+
+class FakeBucket:
+    # stands in for the GCS bucket, the calls are synchronous like the client and run in threads
+    def __init__(self, pages: int, latency: float) -> None:  # noqa: D107
+        self.pages = pages
+        self.latency = latency
+        self.blobs: dict[str, FakeBlob] = {}
+
+    def get_blob(self, name: str) -> FakeBlob:
+        time.sleep(self.latency)
+        if name not in self.blobs:
+            self.blobs[name] = FakeBlob(name, self.pages, self.latency)
+        return self.blobs[name]
+
+
+class FakeServices:
+    # async stand-ins for GitHub, crawl4ai and the Cohere embed endpoint
+    def __init__(self, latency: float) -> None:  # noqa: D107
+        self.latency = latency
+        self.calls = {"github": 0, "portfolio": 0, "embed": 0}
+
+    async def process_github(self, username: str) -> str:
+        self.calls["github"] += 1
+        await asyncio.sleep(self.latency)
+        return f"GitHub profile of {username}\n{candidate_text(username, 30)}"
+
+    async def process_portfolio(self, url: str) -> str:
+        self.calls["portfolio"] += 1
+        await asyncio.sleep(self.latency)
+        return f"URL: {url}\n# Portfolio\n{candidate_text(url, 20)}"
+
+    async def embed_texts(self, texts: list[str], _: str) -> list[list[float]]:
+        self.calls["embed"] += 1
+        await asyncio.sleep(self.latency)
+        return [
+            [random.Random(text).uniform(-1, 1) for _ in range(EMBEDDING_DIMENSIONS)]  # noqa: S311
+            for text in texts
+        ]
+
+
+class FakeQueue:
+    # records the jobs the pipeline enqueues instead of sending them to SAQ
+    def __init__(self) -> None:  # noqa: D107
+        self.enqueued: list[dict[str, object]] = []
+
+    async def enqueue(self, function: str, **kwargs: object) -> None:
+        self.enqueued.append({"function": function, **kwargs})
@@ -0,0 +1,361 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import UTC, datetime
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+from litestar import Litestar
+from litestar.di import Provide
+from litestar.plugins.sqlalchemy import SQLAlchemyPlugin
+from litestar.testing import AsyncTestClient
+from litestar_saq import TaskQueues
+from saq import Queue
+from sqlalchemy import delete, func, insert, or_, select
+
+from benchmarks.fakes import FakeBucket, FakeQueue, FakeServices, candidate_text
+from config import (
+    DB_CONFIG,
+    DEFAULT_GENAI_MODEL,
+    ENRICHMENT_BATCH_SIZE,
+    ENRICHMENT_CONCURRENCY,
+    ENRICHMENT_GENAI_MODEL,
+    SCORING_BATCH_MAX_SIZE,
+)
+from controllers.job_application import JobApplicationController
+from models import Agent, Candidate, Job, JobApplication, LLMCall, ResumeText
+from utils import candidate as candidate_module
+from utils import embedding as embedding_module
+from utils.candidate import process_candidate, shutdown_pdf_executor
+from utils.ledger import flush_llm_ledger
+from utils.llm import FakeLLM, set_llm
+from utils.scoring import precompute_job_scores
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = [10, 100, 1000]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark candidate enrichment and ranking against local fakes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="candidate counts to run")
+    parser.add_argument("--output", type=Path, help="JSON results file, printed to stdout when omitted")
+    parser.add_argument("--requests", type=int, default=50, help="ranking requests per size")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds per simulated LLM call")
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0, help="share of LLM calls failing with 429/5xx")
+    parser.add_argument("--io-latency", type=float, default=0.05, help="seconds per GitHub, GCS, crawl and embed call")
+    parser.add_argument("--resume-pages", type=int, default=2, help="pages per generated resume")
+    parser.add_argument("--genai-model", default=DEFAULT_GENAI_MODEL, help="model the ranking is scored with")
+    parser.add_argument("--seed", type=int, default=0)
+    # internal, each size runs in its own process so peak RSS is measured per size
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    cuts = statistics.quantiles(samples, n=100, method="inclusive") if len(samples) > 1 else samples * 99
+    return {
+        "p50": round(cuts[49] * 1000, 2),
+        "p95": round(cuts[94] * 1000, 2),
+        "p99": round(cuts[98] * 1000, 2),
+        "max": round(max(samples) * 1000, 2),
+    }
+
+
+def peak_rss_mb(who: int) -> float:
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(resource.getrusage(who).ru_maxrss / scale, 1)
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],  # noqa: S607
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def create_tables() -> None:
+    async with DB_CONFIG.get_engine().begin() as connection:
+        await connection.run_sync(Candidate.metadata.create_all)
+
+
+async def seed(size: int, run_id: str) -> tuple[int, int, list[int]]:
+    async with DB_CONFIG.get_session() as db_session, db_session.begin():
+        # process_candidate claims every unprocessed candidate, the run would enrich real data otherwise
+        pending = await db_session.scalar(select(func.count(Candidate.id)).where(Candidate.data_processed == False))
+        if pending:
+            msg = f"{pending} unprocessed candidates already exist, run the benchmark against an empty database"
+            raise RuntimeError(msg)
+
+        agent_id = await db_session.scalar(
+            insert(Agent)
+            .values(agent_name=f"benchmark-{run_id}", agent_instructions="Prefer backend engineers.")
+            .returning(Agent.id),
+        )
+        job_id = await db_session.scalar(
+            insert(Job)
+            .values(
+                job_title="Senior Backend Engineer",
+                job_location="Remote",
+                job_description=candidate_text(f"{run_id}:description", 15),
+                job_requirements=candidate_text(f"{run_id}:requirements", 10),
+                job_contact_email="jobs@example.com",
+                default_agent_id=agent_id,
+            )
+            .returning(Job.id),
+        )
+        candidate_ids = list(
+            await db_session.scalars(
+                insert(Candidate)
+                .values(
+                    [
+                        {
+                            "candidate_name": f"Candidate {index}",
+                            "candidate_email": f"candidate{index}@example.com",
+                            "candidate_phone": "000",
+                            "candidate_current_role": "Software Engineer",
+                            "candidate_current_yoe": index % 15,
+                            "candidate_resume_id": f"benchmark/{run_id}/{index}.pdf",
+                            "candidate_linkedin": "",
+                            "candidate_github": f"benchmark-{run_id}-{index}",
+                            "candidate_portfolio": f"https://example.com/{run_id}/{index}",
+                        }
+                        for index in range(size)
+                    ],
+                )
+                .returning(Candidate.id),
+            ),
+        )
+        await db_session.execute(
+            insert(JobApplication),
+            [{"job_id": job_id, "candidate_id": candidate_id} for candidate_id in candidate_ids],
+        )
+
+    return job_id, agent_id, candidate_ids  # type: ignore
+
+
+async def cleanup(job_id: int, agent_id: int, candidate_ids: list[int], bucket: FakeBucket) -> None:
+    content_keys = [f"md5:{blob.md5_hash}" for blob in bucket.blobs.values()]
+    async with DB_CONFIG.get_session() as db_session, db_session.begin():
+        # applications and fit scores go with the job through the cascades
+        await db_session.execute(delete(Job).where(Job.id == job_id))
+        await db_session.execute(delete(Candidate).where(Candidate.id.in_(candidate_ids)))
+        await db_session.execute(delete(Agent).where(Agent.id == agent_id))
+        await db_session.execute(delete(ResumeText).where(ResumeText.content_key.in_(content_keys)))
+        await db_session.execute(
+            delete(LLMCall).where(or_(LLMCall.job_id == job_id, LLMCall.candidate_id.in_(candidate_ids))),
+        )
+
+
+async def run_enrichment(ctx: dict[str, Any], candidate_ids: list[int], llm: FakeLLM) -> dict[str, Any]:
+    calls = llm.calls
+    started = time.perf_counter()
+    passes = 0
+    remaining = len(candidate_ids)
+
+    # one pass is one cron run of the worker, repeated until every candidate is processed or a pass makes no progress
+    while remaining:
+        await process_candidate(ctx)
+        passes += 1
+        async with DB_CONFIG.get_session() as db_session:
+            left = await db_session.scalar(
+                select(func.count(Candidate.id)).where(
+                    Candidate.id.in_(candidate_ids),
+                    Candidate.data_processed == False,
+                ),
+            )
+        if left == remaining:
+            break
+        remaining = left
+
+    elapsed = time.perf_counter() - started
+    return {
+        "seconds": round(elapsed, 3),
+        "passes": passes,
+        "unprocessed": remaining,
+        "candidates_per_minute": round(len(candidate_ids) / elapsed * 60, 1),
+        "llm_calls_per_candidate": round((llm.calls - calls) / len(candidate_ids), 3),
+    }
+
+
+async def run_scoring(  # noqa: PLR0913, PLR0917
+    ctx: dict[str, Any],
+    job_id: int,
+    agent_id: int,
+    genai_model: str,
+    llm: FakeLLM,
+    size: int,
+) -> dict[str, Any]:
+    calls = llm.calls
+    started = time.perf_counter()
+    counts = await precompute_job_scores(ctx, job_id=job_id, agent_id=agent_id, genai_model=genai_model)
+    elapsed = time.perf_counter() - started
+    return {
+        "seconds": round(elapsed, 3),
+        "candidates_per_minute": round(size / elapsed * 60, 1),
+        "llm_calls_per_candidate": round((llm.calls - calls) / size, 3),
+        **counts,
+    }
+
+
+async def run_ranking(job_id: int, agent_id: int, genai_model: str, requests: int) -> dict[str, Any]:
+    queue = FakeQueue()
+    # only the controller under test, the SAQ plugin would start workers that call the real providers
+    app = Litestar(
+        route_handlers=[JobApplicationController],
+        plugins=[SQLAlchemyPlugin(DB_CONFIG)],
+        dependencies={
+            "task_queues": Provide(
+                lambda: TaskQueues(queues={"candidate_data_processing": queue}),  # type: ignore
+                sync_to_thread=False,
+            ),
+        },
+        signature_types=[Queue, TaskQueues],
+    )
+    path = f"/job-applications/{job_id}/{agent_id}/{genai_model}"
+    first_page: list[float] = []
+    pages: list[float] = []
+
+    async with AsyncTestClient(app) as client:
+        for _ in range(requests):
+            started = time.perf_counter()
+            response = await client.get(path)
+            first_page.append(time.perf_counter() - started)
+            response.raise_for_status()
+
+        # one full walk through the cursor pages, the deepest page should cost about as much as the first
+        cursor = None
+        while True:
+            started = time.perf_counter()
+            response = await client.get(path, params={"cursor": cursor} if cursor else None)
+            pages.append(time.perf_counter() - started)
+            response.raise_for_status()
+            cursor = response.json()["next_cursor"]
+            if cursor is None:
+                break
+
+    return {
+        "requests": requests,
+        "latency_ms": percentiles(first_page),
+        "pages": len(pages),
+        "page_latency_ms": percentiles(pages),
+        "precompute_enqueued": len(queue.enqueued),
+    }
+
+
+async def run_size(args: argparse.Namespace, size: int) -> dict[str, Any]:
+    run_id = uuid.uuid4().hex[:8]
+    llm = FakeLLM(latency=args.llm_latency, failure_rate=args.llm_failure_rate, seed=args.seed)
+    services = FakeServices(args.io_latency)
+    bucket = FakeBucket(args.resume_pages, args.io_latency)
+
+    set_llm(llm)
+    candidate_module.process_github = services.process_github  # type: ignore
+    candidate_module.process_portfolio = services.process_portfolio  # type: ignore
+    candidate_module.get_bucket = lambda: bucket  # type: ignore
+    embedding_module.embed_texts = services.embed_texts  # type: ignore
+
+    await create_tables()
+    job_id, agent_id, candidate_ids = await seed(size, run_id)
+    ctx: dict[str, Any] = {"worker": SimpleNamespace(queue=FakeQueue())}
+
+    try:
+        enrichment = await run_enrichment(ctx, candidate_ids, llm)
+        scoring = await run_scoring(ctx, job_id, agent_id, args.genai_model, llm, size)
+        ranking = await run_ranking(job_id, agent_id, args.genai_model, args.requests)
+    finally:
+        await flush_llm_ledger(ctx)
+        await cleanup(job_id, agent_id, candidate_ids, bucket)
+        await shutdown_pdf_executor(ctx)
+        await DB_CONFIG.get_engine().dispose()
+
+    return {
+        "candidates": size,
+        "enrichment": enrichment,
+        "scoring": scoring,
+        "ranking": ranking,
+        "service_calls": services.calls,
+        "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF),
+        "peak_children_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def run_children(args: argparse.Namespace) -> list[dict[str, Any]]:
+    results = []
+    for size in args.sizes:
+        with tempfile.NamedTemporaryFile(suffix=".json") as output:
+            command = [
+                sys.executable,
+                "-m",
+                "benchmarks.pipeline",
+                "--child",
+                "--sizes",
+                str(size),
+                "--output",
+                output.name,
+            ]
+            command += ["--requests", str(args.requests), "--llm-latency", str(args.llm_latency)]
+            command += ["--llm-failure-rate", str(args.llm_failure_rate), "--io-latency", str(args.io_latency)]
+            command += ["--resume-pages", str(args.resume_pages), "--genai-model", args.genai_model]
+            command += ["--seed", str(args.seed)]
+            logger.info("Running the pipeline benchmark with %s candidates", size)
+            # the fake calls must not end up in the METRICS_DIR the api on this host serves
+            subprocess.run(command, check=True, env={**os.environ, "METRICS_ENABLED": "false"})  # noqa: S603
+            results.append(json.loads(Path(output.name).read_text()))
+    return results
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    args = parse_args()
+
+    if args.child:
+        result = asyncio.run(run_size(args, args.sizes[0]))
+        args.output.write_text(json.dumps(result))
+        return
+
+    report = {
+        "benchmark": "pipeline",
+        "created_at": datetime.now(UTC).isoformat(),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "settings": {
+            "llm_latency": args.llm_latency,
+            "llm_failure_rate": args.llm_failure_rate,
+            "io_latency": args.io_latency,
+            "resume_pages": args.resume_pages,
+            "genai_model": args.genai_model,
+            "enrichment_genai_model": ENRICHMENT_GENAI_MODEL,
+            "enrichment_batch_size": ENRICHMENT_BATCH_SIZE,
+            "enrichment_concurrency": ENRICHMENT_CONCURRENCY,
+            "scoring_batch_max_size": SCORING_BATCH_MAX_SIZE,
+        },
+        "results": run_children(args),
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n")
+    else:
+        print(text)  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
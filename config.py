@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import os
+import tempfile
 
 import cohere
 import google.generativeai as GOOGLE_GENAI
@@ -19,6 +20,17 @@ load_dotenv()
 # github
 GITHUB_USERNAME = os.environ.get("GITHUB_USERNAME")
 GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
+GITHUB_CONCURRENCY = int(os.environ.get("GITHUB_CONCURRENCY", "10"))
+GITHUB_DEADLINE = float(os.environ.get("GITHUB_DEADLINE", "60"))
+GITHUB_CACHE_TTL = int(os.environ.get("GITHUB_CACHE_TTL", "3600"))
+GITHUB_CACHE_MAX_AGE = int(os.environ.get("GITHUB_CACHE_MAX_AGE", "604800"))
+GITHUB_RATE_LIMIT_SLOWDOWN = int(os.environ.get("GITHUB_RATE_LIMIT_SLOWDOWN", "500"))
+GITHUB_RATE_LIMIT_RESERVE = int(os.environ.get("GITHUB_RATE_LIMIT_RESERVE", "50"))
+GITHUB_RATE_LIMIT_MAX_WAIT = int(os.environ.get("GITHUB_RATE_LIMIT_MAX_WAIT", "120"))
+
+# storage
+GCS_BUCKET = os.environ.get("GCS_BUCKET", "nexus-genai25")
+SIGNED_URL_EXPIRATION = int(os.environ.get("SIGNED_URL_EXPIRATION", "30"))
 
 # openapi
 OPENAPI_CONFIG = OpenAPIConfig(
@@ -64,21 +76,133 @@ GENERATION_CONFIG = generation_types.GenerationConfig(
     response_mime_type="text/plain",
 )
 
+JSON_GENERATION_CONFIG = generation_types.GenerationConfig(
+    temperature=1,
+    top_p=0.95,
+    top_k=40,
+    max_output_tokens=8192,
+    response_mime_type="application/json",
+)
+
+PROFILE_GENERATION_CONFIG = generation_types.GenerationConfig(
+    temperature=1,
+    top_p=0.95,
+    top_k=40,
+    max_output_tokens=8192,
+    response_mime_type="application/json",
+    response_schema={
+        "type": "OBJECT",
+        "properties": {
+            "skills": {"type": "ARRAY", "items": {"type": "STRING"}},
+            "summary": {"type": "STRING"},
+        },
+        "required": ["skills", "summary"],
+    },
+)
+
 COHERE_API_KEY = os.environ.get("COHERE_API_KEY")
 if COHERE_API_KEY:
     COHERE = cohere.AsyncClientV2(api_key=COHERE_API_KEY)
 else:
     raise ValueError("COHERE_API_KEY environment variable not set")
 
+# llm
+LLM_PROVIDER = os.environ.get("LLM_PROVIDER", "live")
+GEMINI_CONTEXT_CACHE_TTL = int(os.environ.get("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "32768"))
+GEMINI_CONTEXT_CACHE_MAX_ENTRIES = int(os.environ.get("GEMINI_CONTEXT_CACHE_MAX_ENTRIES", "32"))
+# rate limits apply per process, split the provider quota between the api and the workers, 0 disables a limit
+LLM_REQUESTS_PER_MINUTE = {
+    "gemini": int(os.environ.get("GEMINI_REQUESTS_PER_MINUTE", "1000")),
+    "cohere": int(os.environ.get("COHERE_REQUESTS_PER_MINUTE", "500")),
+}
+LLM_TOKENS_PER_MINUTE = {
+    "gemini": int(os.environ.get("GEMINI_TOKENS_PER_MINUTE", "1000000")),
+    "cohere": int(os.environ.get("COHERE_TOKENS_PER_MINUTE", "500000")),
+}
+LLM_FAILOVER_MODELS = {
+    "gemini": os.environ.get("GEMINI_FAILOVER_MODEL", "command-r-plus-08-2024"),
+    "cohere": os.environ.get("COHERE_FAILOVER_MODEL", "gemini-1.5-flash"),
+}
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BASE_DELAY = float(os.environ.get("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.environ.get("LLM_RETRY_MAX_DELAY", "8"))
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", "0"))
+LLM_LEDGER_BATCH_SIZE = int(os.environ.get("LLM_LEDGER_BATCH_SIZE", "500"))
+LLM_LEDGER_FLUSH_INTERVAL = float(os.environ.get("LLM_LEDGER_FLUSH_INTERVAL", "5"))
+LLM_LEDGER_MAX_PENDING = int(os.environ.get("LLM_LEDGER_MAX_PENDING", "10000"))
+
+# scoring
+SCORING_CONCURRENCY = {
+    "gemini": int(os.environ.get("GEMINI_SCORING_CONCURRENCY", "8")),
+    "cohere": int(os.environ.get("COHERE_SCORING_CONCURRENCY", "4")),
+}
+SCORING_TIMEOUT = float(os.environ.get("SCORING_TIMEOUT", "30"))
+SCORING_BATCH_TIMEOUT = float(os.environ.get("SCORING_BATCH_TIMEOUT", "90"))
+SCORING_BATCH_TOKEN_BUDGET = int(os.environ.get("SCORING_BATCH_TOKEN_BUDGET", "60000"))
+SCORING_BATCH_MAX_SIZE = int(os.environ.get("SCORING_BATCH_MAX_SIZE", "20"))
+DEFAULT_GENAI_MODEL = os.environ.get("DEFAULT_GENAI_MODEL", "gemini-1.5-flash-8b")
+PRECOMPUTE_MAX_PASSES = int(os.environ.get("PRECOMPUTE_MAX_PASSES", "3"))
+SCORING_FAILURE_RETRY_AFTER = int(os.environ.get("SCORING_FAILURE_RETRY_AFTER", "3600"))
+SCORING_CHUNK_SIZE = int(os.environ.get("SCORING_CHUNK_SIZE", "200"))
+APPLICATIONS_PAGE_SIZE = int(os.environ.get("APPLICATIONS_PAGE_SIZE", "50"))
+APPLICATIONS_MAX_PAGE_SIZE = int(os.environ.get("APPLICATIONS_MAX_PAGE_SIZE", "500"))
+
+# embeddings
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "embed-english-v3.0")
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "96"))
+SHORTLIST_SIZE = int(os.environ.get("SHORTLIST_SIZE", "50"))
+SHORTLIST_MAX_SIZE = int(os.environ.get("SHORTLIST_MAX_SIZE", "1000"))
+
+# enrichment
+ENRICHMENT_GENAI_MODEL = os.environ.get("ENRICHMENT_GENAI_MODEL", "gemini-1.5-flash-8b")
+ENRICHMENT_BATCH_SIZE = int(os.environ.get("ENRICHMENT_BATCH_SIZE", "20"))
+ENRICHMENT_CONCURRENCY = int(os.environ.get("ENRICHMENT_CONCURRENCY", "4"))
+ENRICHMENT_LEASE_SECONDS = int(os.environ.get("ENRICHMENT_LEASE_SECONDS", "900"))
+ENRICHMENT_MAX_ATTEMPTS = int(os.environ.get("ENRICHMENT_MAX_ATTEMPTS", "5"))
+RESUME_MAX_BYTES = int(os.environ.get("RESUME_MAX_BYTES", "10485760"))
+RESUME_MAX_PAGES = int(os.environ.get("RESUME_MAX_PAGES", "30"))
+RESUME_PAGES_PER_WORKER = int(os.environ.get("RESUME_PAGES_PER_WORKER", "8"))
+RESUME_PARSE_WORKERS = int(os.environ.get("RESUME_PARSE_WORKERS", "2"))
+RESUME_CACHE_MAX_AGE = int(os.environ.get("RESUME_CACHE_MAX_AGE", "2592000"))
+PORTFOLIO_MAX_PAGES = int(os.environ.get("PORTFOLIO_MAX_PAGES", "10"))
+PORTFOLIO_MAX_BYTES = int(os.environ.get("PORTFOLIO_MAX_BYTES", "2097152"))
+PORTFOLIO_CONCURRENCY = int(os.environ.get("PORTFOLIO_CONCURRENCY", "4"))
+PORTFOLIO_DEADLINE = float(os.environ.get("PORTFOLIO_DEADLINE", "60"))
+PORTFOLIO_SITEMAP_TIMEOUT = float(os.environ.get("PORTFOLIO_SITEMAP_TIMEOUT", "20"))
+PORTFOLIO_LLM_CLEANUP = os.environ.get("PORTFOLIO_LLM_CLEANUP", "false").lower() == "true"
+CRAWLER_POOL_SIZE = int(os.environ.get("CRAWLER_POOL_SIZE", "2"))
+CRAWLER_PAGES_PER_BROWSER = int(os.environ.get("CRAWLER_PAGES_PER_BROWSER", "8"))
+CRAWLER_RECYCLE_PAGES = int(os.environ.get("CRAWLER_RECYCLE_PAGES", "100"))
+
+# metrics
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+# shared by the api and the SAQ worker processes of one host, each process keeps its own file in it
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "nexus-metrics"))  # noqa: PTH118
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "5"))
+
 # saq
+SAQ_WORKER_PROCESSES = int(os.environ.get("SAQ_WORKER_PROCESSES", "1"))
+
 SAQ = SAQPlugin(
     config=SAQConfig(
         web_enabled=True,
         use_server_lifespan=True,
+        worker_processes=SAQ_WORKER_PROCESSES,
         queue_configs=[
             QueueConfig(
                 dsn=DATABASE_URL_SAQ,
                 name="candidate_data_processing",
+                tasks=["utils.scoring.precompute_job_scores"],
+                startup=["utils.portfolio.start_crawler_pool"],
+                shutdown=[
+                    "utils.github_parse.close_github_client",
+                    "utils.candidate.shutdown_pdf_executor",
+                    "utils.portfolio.close_crawler_pool",
+                    "utils.llm.clear_context_cache",
+                    "utils.metrics.flush_metrics",
+                    "utils.ledger.flush_llm_ledger",
+                ],
                 scheduled_tasks=[
                     CronJob(
                         function="utils.candidate.process_candidate",
@@ -86,6 +210,16 @@ SAQ = SAQPlugin(
                         timeout=600,
                         ttl=2000,
                     ),
+                    CronJob(
+                        function="utils.github_parse.evict_github_cache",
+                        cron="0 * * * *",
+                        timeout=300,
+                    ),
+                    CronJob(
+                        function="utils.candidate.evict_resume_cache",
+                        cron="30 * * * *",
+                        timeout=300,
+                    ),
                 ],
             ),
         ],
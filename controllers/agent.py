@@ -3,9 +3,13 @@ from __future__ import annotations
 from advanced_alchemy.extensions.litestar import providers
 from litestar import Controller, delete, get, post, put
 from litestar.plugins.sqlalchemy import repository, service
+from litestar_saq import TaskQueues
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from models import Agent
+from models import Agent, FitScore, Job
 from schema.agent import AgentCreate, AgentResponse, AgentUpdate
+from utils.scoring import enqueue_precompute, enqueue_scored_pairs
 
 
 class AgentService(service.SQLAlchemyAsyncRepositoryService[Agent]):
@@ -46,8 +50,18 @@ class AgentController(Controller):
         agent_id: int,
         data: AgentUpdate,
         agent_service: AgentService,
+        task_queues: TaskQueues,
+        db_session: AsyncSession,
     ) -> AgentResponse:
-        obj = await agent_service.update(data=data, item_id=agent_id)
+        # committed before enqueueing so the worker never scores against the previous instructions
+        obj = await agent_service.update(data=data, item_id=agent_id, auto_commit=True)
+
+        queue = task_queues.get("candidate_data_processing")
+        job_ids = await db_session.scalars(select(Job.id).where(Job.default_agent_id == agent_id))
+        for job_id in job_ids:
+            await enqueue_precompute(queue, job_id)
+        await enqueue_scored_pairs(db_session, queue, FitScore.agent_id == agent_id)
+
         return agent_service.to_schema(obj, schema_type=AgentResponse)
 
     @delete("/{agent_id:int}", status_code=200)
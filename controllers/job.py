@@ -3,12 +3,16 @@ from __future__ import annotations
 from typing import Annotated
 
 from advanced_alchemy.extensions.litestar import providers
-from litestar import Controller, delete, get, post
+from advanced_alchemy.service import schema_dump
+from litestar import Controller, delete, get, post, put
 from litestar.params import Dependency
 from litestar.plugins.sqlalchemy import repository, service
+from litestar_saq import TaskQueues
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from models import Job
-from schema.job import JobCreate, JobResponse
+from models import FitScore, Job
+from schema.job import JobCreate, JobResponse, JobUpdate
+from utils.scoring import enqueue_precompute, enqueue_scored_pairs
 
 
 class JobService(service.SQLAlchemyAsyncRepositoryService[Job]):
@@ -46,6 +50,27 @@ class JobController(Controller):
         obj = await job_service.create(data)
         return job_service.to_schema(obj, schema_type=JobResponse)
 
+    @put("/{job_id:int}")
+    async def update_job(
+        self,
+        job_id: int,
+        data: JobUpdate,
+        job_service: JobService,
+        task_queues: TaskQueues,
+        db_session: AsyncSession,
+    ) -> JobResponse:
+        # committed before enqueueing so the worker never scores against the previous job description,
+        # the embedding is cleared so the next shortlist or worker pass embeds the new one
+        obj = await job_service.update(
+            data=schema_dump(data) | {"job_embedding": None},
+            item_id=job_id,
+            auto_commit=True,
+        )
+        queue = task_queues.get("candidate_data_processing")
+        await enqueue_precompute(queue, job_id)
+        await enqueue_scored_pairs(db_session, queue, FitScore.job_id == job_id)
+        return job_service.to_schema(obj, schema_type=JobResponse)
+
     @delete("/{job_id:int}", status_code=200)
     async def delete_job(self, job_id: int, job_service: JobService) -> JobResponse:
         obj = await job_service.delete(job_id)
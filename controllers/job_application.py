@@ -1,19 +1,61 @@
 from __future__ import annotations
 
-from contextlib import suppress
-from datetime import timedelta
+from collections.abc import AsyncIterator  # noqa: TC003
+from datetime import UTC, datetime
+from typing import Annotated
 
-import cohere
 from advanced_alchemy.extensions.litestar import providers
-from google.cloud import storage
 from litestar import Controller, MediaType, Response, delete, get, post, put, status_codes
+from litestar.params import Parameter
 from litestar.plugins.sqlalchemy import repository, service
-from sqlalchemy import select
+from litestar.response import ServerSentEvent, ServerSentEventMessage
+from litestar_saq import TaskQueues
+from msgspec import convert, json
+from sqlalchemy import delete as sql_delete
+from sqlalchemy import func, select, tuple_
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from config import COHERE, GENERATION_CONFIG, GOOGLE_GENAI
-from models import Agent, Candidate, GenAIModel, Job, JobApplication
-from schema.job_application import CandidateCreate, CandidateUpdate, JobApplicationsResponse, JobApplicationUpdate
+from config import APPLICATIONS_MAX_PAGE_SIZE, APPLICATIONS_PAGE_SIZE, DB_CONFIG, SHORTLIST_MAX_SIZE, SHORTLIST_SIZE
+from models import Agent, Candidate, FitScore, GenAIModel, Job, JobApplication, LLMPurpose, ResumeText, ScoreStatus
+from schema.job_application import (
+    CandidateCreate,
+    CandidateUpdate,
+    JobApplicationsPage,
+    JobApplicationsResponse,
+    JobApplicationUpdate,
+    SignedUrlsRequest,
+)
+from utils.embedding import (
+    build_shortlist_query,
+    build_shortlist_read_query,
+    get_job_embedding,
+    prepare_shortlist_scan,
+)
+from utils.ledger import LLMCallContext
+from utils.metrics import record_cache, timed
+from utils.pagination import decode_cursor, encode_cursor
+from utils.scoring import (
+    PendingScore,
+    after_score,
+    build_application,
+    build_batch_system_instruction,
+    build_candidate_data,
+    build_ranking_query,
+    build_ranking_read_query,
+    build_system_instruction,
+    compute_input_hash,
+    enqueue_precompute,
+    enqueue_scored_pairs,
+    failure_retry_cutoff,
+    filter_ranking_query,
+    load_ranking_chunk,
+    read_score_status,
+    save_fit_scores,
+    score_candidate,
+    score_pending,
+    split_cached_scores,
+)
+from utils.storage import get_upload_urls
 
 
 class JobApplicationService(service.SQLAlchemyAsyncRepositoryService[JobApplication]):
@@ -34,10 +76,46 @@ class JobApplicationController(Controller):
     @get("/")
     async def get_all_job_applications(
         self,
-        job_applications_service: JobApplicationService,
-    ) -> service.OffsetPagination[JobApplicationsResponse]:
-        obj = await job_applications_service.list()
-        return job_applications_service.to_schema(obj, schema_type=JobApplicationsResponse)
+        db_session: AsyncSession,
+        cursor: str | None = None,
+        limit: Annotated[int, Parameter(ge=1, le=APPLICATIONS_MAX_PAGE_SIZE)] = APPLICATIONS_PAGE_SIZE,
+        job_id: int | None = None,
+        data_processed: bool | None = None,  # noqa: FBT001
+    ) -> JobApplicationsPage | Response:
+        # newest first, keyset on (created_at, id) so deep pages cost the same as the first one
+        query = select(JobApplication).order_by(JobApplication.created_at.desc(), JobApplication.id.desc())
+
+        if cursor is not None:
+            after = decode_cursor(cursor, tuple[datetime, int])
+            if after is None:
+                return Response(
+                    status_code=status_codes.HTTP_400_BAD_REQUEST,
+                    media_type=MediaType.JSON,
+                    content={"status": "error", "message": "Invalid cursor"},
+                )
+            query = query.where(tuple_(JobApplication.created_at, JobApplication.id) < tuple_(*after))
+
+        if job_id is not None:
+            query = query.where(JobApplication.job_id == job_id)
+
+        if data_processed is not None:
+            query = query.join(Candidate, JobApplication.candidate_id == Candidate.id).where(
+                Candidate.data_processed == data_processed,
+            )
+
+        job_applications = list(await db_session.scalars(query.limit(limit + 1)))
+        next_cursor = None
+        if len(job_applications) > limit:
+            job_applications = job_applications[:limit]
+            next_cursor = encode_cursor(job_applications[-1].created_at, job_applications[-1].id)
+
+        return JobApplicationsPage(
+            items=[
+                convert(job_application, JobApplicationsResponse, from_attributes=True)
+                for job_application in job_applications
+            ],
+            next_cursor=next_cursor,
+        )
 
     @delete("/{job_application_id:int}", status_code=200)
     async def delete_job_application(
@@ -100,25 +178,62 @@ class JobApplicationController(Controller):
 
     @get("/signed-url/{blob_name:str}")
     async def get_signed_url(self, blob_name: str) -> str:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket("nexus-genai25")
-        blob = bucket.blob(blob_name)
-
-        return blob.generate_signed_url(
-            version="v4",
-            expiration=timedelta(seconds=30),
-            method="PUT",
+        upload_urls = await get_upload_urls([blob_name])
+        return upload_urls[blob_name]
+
+    @post("/signed-urls", status_code=200)
+    async def get_signed_urls(self, data: SignedUrlsRequest) -> Response:
+        return Response(
+            status_code=status_codes.HTTP_200_OK,
+            media_type=MediaType.JSON,
+            content={"status": "success", "signed_urls": await get_upload_urls(data.blob_names)},
+        )
+
+    @get("/resume-cache")
+    async def get_resume_cache_stats(self, db_session: AsyncSession) -> Response:
+        result = await db_session.execute(
+            select(
+                func.count(ResumeText.id).label("entries"),
+                func.coalesce(func.sum(ResumeText.hits), 0).label("hits"),
+                func.coalesce(func.sum(ResumeText.misses), 0).label("misses"),
+                func.coalesce(func.sum(ResumeText.hits * ResumeText.size), 0).label("bytes_saved"),
+            ),
+        )
+        stats = result.one()
+
+        # counted over the entries still cached, evicted resumes take their hits and misses with them
+        lookups = stats.hits + stats.misses
+
+        return Response(
+            status_code=status_codes.HTTP_200_OK,
+            media_type=MediaType.JSON,
+            content={
+                "status": "success",
+                "entries": stats.entries,
+                "hits": stats.hits,
+                "misses": stats.misses,
+                "hit_ratio": stats.hits / lookups if lookups else 0,
+                "bytes_saved": stats.bytes_saved,
+            },
         )
 
     @get("/{job_id:int}/{agent_id:int}/{genai_model:str}")
-    async def get_job_applications(
+    async def get_job_applications(  # noqa: C901, PLR0912, PLR0913, PLR0917
         self,
         job_id: int,
         agent_id: int,
         genai_model: str,
         db_session: AsyncSession,
+        task_queues: TaskQueues,
+        rescore: int | None = None,
+        cursor: str | None = None,
+        limit: Annotated[int, Parameter(ge=1, le=APPLICATIONS_MAX_PAGE_SIZE)] = APPLICATIONS_PAGE_SIZE,
+        data_processed: bool | None = None,  # noqa: FBT001
+        min_score: int | None = None,
+        max_score: int | None = None,
     ) -> Response:
         GENAI_MODEL = GenAIModel(genai_model)
+        read_at = datetime.now(UTC)
 
         agent = await db_session.scalar(select(Agent).where(Agent.id == agent_id))
 
@@ -138,82 +253,79 @@ class JobApplicationController(Controller):
                 content={"status": "error", "message": "Job not found"},
             )
 
-        query = (
-            select(
-                JobApplication.id,
-                Candidate.candidate_name,
-                Candidate.candidate_email,
-                Candidate.candidate_phone,
-                Candidate.candidate_current_yoe,
-                Candidate.candidate_current_role,
-                Candidate.candidate_resume_id,
-                Candidate.data_processed,
-                Candidate.candidate_image,
-                Candidate.candidate_resume_data,
-                Candidate.candidate_linkedin_data,
-                Candidate.candidate_github_data,
-                Candidate.candidate_portfolio_data,
-                JobApplication.created_at,
-                JobApplication.candidate_summary,
-                JobApplication.candidate_skills,
-            )
-            .join(Candidate, JobApplication.candidate_id == Candidate.id)
-            .where(JobApplication.job_id == job_id)
-        )
+        query = build_ranking_read_query(job_id, agent_id, GENAI_MODEL)
 
-        result = await db_session.execute(query)
-        applications = []
+        if cursor is not None:
+            after = decode_cursor(cursor, tuple[int | None, int])
+            if after is None:
+                return Response(
+                    status_code=status_codes.HTTP_400_BAD_REQUEST,
+                    media_type=MediaType.JSON,
+                    content={"status": "error", "message": "Invalid cursor"},
+                )
+            query = query.where(after_score(*after))
 
-        for row in result:
-            progress = 0
-
-            system_instruction = f"SYSTEM: You are a AI agent named {agent.agent_name} helping recruiters to process the candidate applications. Your task is to analyze the provided candidate information and generate how much the candidate is suitable for the job. The higher the number, the more suitable the candidate is for the job.\n\nAGENT_INSTRUCTION: {agent.agent_instructions}\n\nJOB_DESCRIPTION: {job.job_description}\n\nJOB_REQUIREMENTS: {job.job_requirements}\n\nSYSTEM: Keep in mind that you can only reply with a number between 0 to 100 one time"
-            candidate_data = f"**RESUME:** {row.candidate_resume_data}\n\n\n\n**LINKEDIN:** {row.candidate_linkedin_data}\n\n\n\n**GITHUB:** {row.candidate_github_data}\n\n\n\n**PORTFOLIO:** {row.candidate_portfolio_data}"
-
-            if GENAI_MODEL == GenAIModel.COMMAND_R_PLUS:
-                response = await COHERE.chat(
-                    model=GENAI_MODEL,
-                    messages=[
-                        cohere.SystemChatMessageV2(content=system_instruction),
-                        cohere.UserChatMessageV2(content=candidate_data),
-                    ],
+        query = filter_ranking_query(query, data_processed=data_processed, min_score=min_score, max_score=max_score)
+
+        rescored: tuple[int | None, ScoreStatus] | None = None
+
+        if rescore is not None:
+            result = await db_session.execute(build_ranking_query(job_id).where(JobApplication.id == rescore))
+            row = result.one_or_none()
+
+            if row is None:
+                return Response(
+                    status_code=status_codes.HTTP_404_NOT_FOUND,
+                    media_type=MediaType.JSON,
+                    content={"status": "error", "message": "Job application not found"},
                 )
-                try:
-                    response = response.message.dict()
-                    progress = int(response["content"][0]["text"])
-                except:
-                    pass
+
+            system_instruction = build_system_instruction(agent, job)
+            candidate_data = build_candidate_data(row, GENAI_MODEL)
+            score = await score_candidate(
+                GENAI_MODEL,
+                system_instruction,
+                candidate_data,
+                LLMCallContext(LLMPurpose.SCORE, job_id=job_id, agent_id=agent_id, candidate_id=row.candidate_id),
+            )
+
+            if score is None:
+                rescored = (None, ScoreStatus.UNSCORED)
             else:
-                model = GOOGLE_GENAI.GenerativeModel(  # type: ignore
-                    model_name="gemini-1.5-flash-8b",
-                    generation_config=GENERATION_CONFIG,
-                    system_instruction=system_instruction,
-                )
+                rescored = (score, ScoreStatus.SCORED)
+                item = PendingScore(row, candidate_data, compute_input_hash(system_instruction, candidate_data))
+                await save_fit_scores(db_session, job_id, agent_id, GENAI_MODEL, [(item, score)], read_at=read_at)
 
-                chat_session = model.start_chat()
-
-                response = await chat_session.send_message_async(candidate_data)
-
-                if response.text:
-                    with suppress(ValueError):
-                        progress = int(response.text)
-
-            application = {
-                "id": row.id,
-                "candidate_name": row.candidate_name,
-                "candidate_email": row.candidate_email,
-                "candidate_phone": row.candidate_phone,
-                "candidate_current_yoe": row.candidate_current_yoe,
-                "candidate_current_role": row.candidate_current_role,
-                "candidate_resume": row.candidate_resume_id,
-                "applied_date": row.created_at.isoformat(),
-                "data_processed": row.data_processed,
-                "progress": progress,
-                "summary": row.candidate_summary,
-                "avatar": row.candidate_image,
-                "skills": eval(row.candidate_skills) if row.candidate_skills else [],
-            }
-            applications.append(application)
+        with timed("ranking.read"):
+            rows = list(await db_session.execute(query.limit(limit + 1)))
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].score, rows[-1].id)
+
+        applications = []
+        misses = 0
+        needs_scoring = False
+        retry_cutoff = failure_retry_cutoff()
+        inputs_updated_at = max(job.updated_at, agent.updated_at)
+
+        for row in rows:
+            if rescored is not None and row.id == rescore:
+                progress, score_status = rescored
+            else:
+                score_status, nudge = read_score_status(row, retry_cutoff, inputs_updated_at)
+                progress = row.score
+                needs_scoring = needs_scoring or nudge
+                misses += score_status != ScoreStatus.CACHED
+
+            applications.append(build_application(row, progress, score_status))
+
+        record_cache("ranking", hit=True, amount=len(applications) - misses)
+        record_cache("ranking", hit=False, amount=misses)
+
+        # scores are computed in the background, a read only nudges the worker when processed candidates lack one
+        if needs_scoring:
+            await enqueue_precompute(task_queues.get("candidate_data_processing"), job_id, agent_id, GENAI_MODEL)
 
         return Response(
             status_code=status_codes.HTTP_200_OK,
@@ -221,15 +333,181 @@ class JobApplicationController(Controller):
             content={
                 "status": "success",
                 "job_applications": applications,
+                "cache": {"hits": len(applications) - misses, "misses": misses},
+                "next_cursor": next_cursor,
             },
         )
 
+    @get("/{job_id:int}/{agent_id:int}/{genai_model:str}/stream")
+    async def stream_job_applications(  # noqa: PLR0913, PLR0917
+        self,
+        job_id: int,
+        agent_id: int,
+        genai_model: str,
+        db_session: AsyncSession,
+        batch: bool = False,  # noqa: FBT001, FBT002
+        shortlist: Annotated[int | None, Parameter(ge=1, le=SHORTLIST_MAX_SIZE)] = None,
+    ) -> ServerSentEvent | Response:
+        GENAI_MODEL = GenAIModel(genai_model)  # noqa: N806
+        read_at = datetime.now(UTC)
+
+        agent = await db_session.scalar(select(Agent).where(Agent.id == agent_id))
+
+        if agent is None:
+            return Response(
+                status_code=status_codes.HTTP_404_NOT_FOUND,
+                media_type=MediaType.JSON,
+                content={"status": "error", "message": "Agent not found"},
+            )
+
+        job = await db_session.scalar(select(Job).where(Job.id == job_id))
+
+        if job is None:
+            return Response(
+                status_code=status_codes.HTTP_404_NOT_FOUND,
+                media_type=MediaType.JSON,
+                content={"status": "error", "message": "Job not found"},
+            )
+
+        query = build_ranking_query(job_id)
+
+        # only the nearest candidates by embedding are sent to the model
+        if shortlist is not None:
+            embedding = await get_job_embedding(db_session, job)
+            await prepare_shortlist_scan(db_session, shortlist)
+            shortlist_ids = build_shortlist_query(job_id, embedding, shortlist).with_only_columns(JobApplication.id)
+            query = query.where(JobApplication.id.in_(shortlist_ids))
+
+        system_instruction = build_system_instruction(agent, job)
+        batch_instruction = build_batch_system_instruction(agent, job) if batch else None
+        cached_applications: list[tuple[int, int, dict]] = []
+        pending: list[PendingScore] = []
+        total = 0
+        after_id = 0
+
+        # cached rows are reduced to their response right away, only pending rows keep the candidate data
+        while rows := await load_ranking_chunk(db_session, query, after_id):
+            after_id = rows[-1].id
+            total += len(rows)
+            cached, chunk_pending = await split_cached_scores(
+                db_session,
+                rows,
+                agent_id,
+                GENAI_MODEL,
+                system_instruction,
+            )
+            cached_applications.extend(
+                (cached[row.id], row.id, build_application(row, cached[row.id], ScoreStatus.CACHED))
+                for row in rows
+                if row.id in cached
+            )
+            pending.extend(chunk_pending)
+
+        async def events() -> AsyncIterator[ServerSentEventMessage]:
+            # the request session is closed once the response starts, scores are saved with a worker-style session
+            cached_applications.sort(key=lambda cached_application: (-cached_application[0], cached_application[1]))
+
+            for _, _, application in cached_applications:
+                yield ServerSentEventMessage(event="application", data=json.encode(application).decode())
+
+            scored = []
+            failed: list[tuple[PendingScore, int | None]] = []
+
+            try:
+                async for item, score in score_pending(
+                    GENAI_MODEL,
+                    system_instruction,
+                    pending,
+                    batch_instruction,
+                    LLMCallContext(LLMPurpose.SCORE, job_id=job_id, agent_id=agent_id),
+                ):
+                    if score is None:
+                        failed.append((item, None))
+                        application = build_application(item.row, None, ScoreStatus.UNSCORED)
+                    else:
+                        scored.append((item, score))
+                        application = build_application(item.row, score, ScoreStatus.SCORED)
+
+                    yield ServerSentEventMessage(event="application", data=json.encode(application).decode())
+            finally:
+                async with DB_CONFIG.get_session() as session:
+                    await save_fit_scores(session, job_id, agent_id, GENAI_MODEL, [*scored, *failed], read_at=read_at)
+                    await session.commit()
+
+            summary = {
+                "status": "success",
+                "total": total,
+                "cache": {"hits": len(cached_applications), "misses": len(pending)},
+                "scored": len(scored),
+                "unscored": len(failed),
+            }
+            yield ServerSentEventMessage(event="summary", data=json.encode(summary).decode())
+
+        return ServerSentEvent(events())
+
+    @get("/{job_id:int}/shortlist")
+    async def get_shortlist(
+        self,
+        job_id: int,
+        db_session: AsyncSession,
+        limit: Annotated[int, Parameter(ge=1, le=SHORTLIST_MAX_SIZE)] = SHORTLIST_SIZE,
+    ) -> Response:
+        job = await db_session.scalar(select(Job).where(Job.id == job_id))
+
+        if job is None:
+            return Response(
+                status_code=status_codes.HTTP_404_NOT_FOUND,
+                media_type=MediaType.JSON,
+                content={"status": "error", "message": "Job not found"},
+            )
+
+        embedding = await get_job_embedding(db_session, job)
+        await prepare_shortlist_scan(db_session, limit)
+        result = await db_session.execute(build_shortlist_read_query(job_id, embedding, limit))
+
+        applications = []
+        for row in result:
+            application = build_application(row, None, ScoreStatus.PENDING)
+            application["similarity"] = 1 - row.distance
+            applications.append(application)
+
+        return Response(
+            status_code=status_codes.HTTP_200_OK,
+            media_type=MediaType.JSON,
+            content={"status": "success", "job_applications": applications},
+        )
+
+    @delete("/{job_id:int}/scores", status_code=200)
+    async def invalidate_fit_scores(
+        self,
+        job_id: int,
+        db_session: AsyncSession,
+        agent_id: int | None = None,
+        genai_model: str | None = None,
+    ) -> Response:
+        query = sql_delete(FitScore).where(FitScore.job_id == job_id)
+
+        if agent_id is not None:
+            query = query.where(FitScore.agent_id == agent_id)
+
+        if genai_model is not None:
+            query = query.where(FitScore.genai_model == GenAIModel(genai_model))
+
+        result = await db_session.execute(query)
+
+        return Response(
+            status_code=status_codes.HTTP_200_OK,
+            media_type=MediaType.JSON,
+            content={"status": "success", "message": f"{result.rowcount} fit scores invalidated"},  # type: ignore
+        )
+
     @put("/candidate/{candidate_id:int}")
     async def update_candidate(
         self,
         candidate_id: int,
         data: CandidateUpdate,
         db_session: AsyncSession,
+        task_queues: TaskQueues,
     ) -> Response:
         candidate = await db_session.scalar(
             select(Candidate).where(Candidate.id == candidate_id),
@@ -243,11 +521,29 @@ class JobApplicationController(Controller):
             )
 
         candidate.data_processed = data.data_processed
+        # an edit gives a candidate that ran out of enrichment attempts a fresh set
+        candidate.processing_attempts = 0
         candidate.candidate_image = data.candidate_image  # type: ignore
         candidate.candidate_resume_data = data.candidate_resume_data  # type: ignore
         candidate.candidate_linkedin_data = data.candidate_linkedin_data  # type: ignore
         candidate.candidate_github_data = data.candidate_github_data  # type: ignore
         candidate.candidate_portfolio_data = data.candidate_portfolio_data  # type: ignore
+        candidate.candidate_embedding = None  # type: ignore
+
+        # committed before enqueueing so the worker never scores the previous candidate data, the commit expires
+        # the candidate so only the request data is read after it
+        await db_session.commit()
+
+        if data.data_processed:
+            queue = task_queues.get("candidate_data_processing")
+            job_ids = list(
+                await db_session.scalars(
+                    select(JobApplication.job_id).where(JobApplication.candidate_id == candidate_id),
+                ),
+            )
+            for job_id in job_ids:
+                await enqueue_precompute(queue, job_id)
+            await enqueue_scored_pairs(db_session, queue, FitScore.job_id.in_(job_ids))
 
         return Response(
             status_code=status_codes.HTTP_200_OK,
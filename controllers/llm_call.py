@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+from datetime import datetime  # noqa: TC003
+
+from litestar import Controller, MediaType, Response, get, status_codes
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import GenAIModel, LLMCall, LLMPurpose, LLMUsageGroup
+from utils.ledger import build_usage_query
+
+
+class LLMCallController(Controller):
+    path = "/llm-calls"
+
+    @get("/usage/{group_by:str}")
+    async def get_llm_usage(  # noqa: PLR0913, PLR0917
+        self,
+        group_by: str,
+        db_session: AsyncSession,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        job_id: int | None = None,
+        agent_id: int | None = None,
+        genai_model: GenAIModel | None = None,
+        purpose: LLMPurpose | None = None,
+        by_purpose: bool = False,  # noqa: FBT001, FBT002
+    ) -> Response:
+        if group_by not in LLMUsageGroup:
+            return Response(
+                status_code=status_codes.HTTP_400_BAD_REQUEST,
+                media_type=MediaType.JSON,
+                content={"status": "error", "message": f"Usage can be grouped by {', '.join(LLMUsageGroup)}"},
+            )
+
+        query = build_usage_query(LLMUsageGroup(group_by), by_purpose=by_purpose)
+
+        if since is not None:
+            query = query.where(LLMCall.created_at >= since)
+        if until is not None:
+            query = query.where(LLMCall.created_at < until)
+        if job_id is not None:
+            query = query.where(LLMCall.job_id == job_id)
+        if agent_id is not None:
+            query = query.where(LLMCall.agent_id == agent_id)
+        if genai_model is not None:
+            query = query.where(LLMCall.genai_model == genai_model)
+        if purpose is not None:
+            query = query.where(LLMCall.purpose == purpose)
+
+        result = await db_session.execute(query)
+
+        return Response(
+            status_code=status_codes.HTTP_200_OK,
+            media_type=MediaType.JSON,
+            content={
+                "status": "success",
+                "group_by": group_by,
+                "usage": [row._asdict() for row in result],
+            },
+        )
@@ -1,9 +1,49 @@
+from collections.abc import Callable
+from datetime import datetime
 from enum import StrEnum
 
 from litestar.plugins.sqlalchemy import base
-from sqlalchemy import ForeignKey, UniqueConstraint
-from sqlalchemy.dialects.postgresql import TEXT
+from sqlalchemy import DDL, BigInteger, Float, ForeignKey, Index, UniqueConstraint, cast, event
+from sqlalchemy.dialects.postgresql import JSONB, TEXT
+from sqlalchemy.engine import Dialect
 from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.sql.elements import BindParameter, ColumnElement
+from sqlalchemy.types import UserDefinedType
+
+# must match the output size of EMBEDDING_MODEL
+EMBEDDING_DIMENSIONS = 1024
+
+event.listen(base.orm_registry.metadata, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS vector"))
+
+
+class Vector(UserDefinedType):
+    # pgvector column, values travel as the '[1.0,2.0]' text form
+    cache_ok = True
+
+    def __init__(self, dimensions: int) -> None:  # noqa: D107
+        self.dimensions = dimensions
+
+    def get_col_spec(self, **_: object) -> str:
+        return f"VECTOR({self.dimensions})"
+
+    def bind_expression(self, bindvalue: BindParameter[list[float]]) -> ColumnElement[list[float]]:
+        return cast(bindvalue, self)
+
+    def bind_processor(self, _: Dialect) -> Callable[[list[float] | None], str | None]:
+        def process(value: list[float] | None) -> str | None:
+            return None if value is None else "[" + ",".join(map(str, value)) + "]"
+
+        return process
+
+    def result_processor(self, _: Dialect, __: object) -> Callable[[str | None], list[float] | None]:
+        def process(value: str | None) -> list[float] | None:
+            return None if value is None else [float(item) for item in value[1:-1].split(",")]
+
+        return process
+
+    class comparator_factory(UserDefinedType.Comparator):  # noqa: N801
+        def cosine_distance(self, other: object) -> ColumnElement[float]:
+            return self.op("<=>", return_type=Float)(other)
 
 
 class GenAIModel(StrEnum):
@@ -13,6 +53,34 @@ class GenAIModel(StrEnum):
     COMMAND_R_PLUS = "command-r-plus-08-2024"
 
 
+class ScoreStatus(StrEnum):
+    CACHED = "cached"
+    SCORED = "scored"
+    UNSCORED = "unscored"
+    PENDING = "pending"
+
+
+class LLMPurpose(StrEnum):
+    SCORE = "score"
+    SCORE_BATCH = "score-batch"
+    # skills and summary come from a single call
+    PROFILE = "profile"
+    PORTFOLIO_CLEAN = "portfolio-clean"
+
+
+class LLMCallOutcome(StrEnum):
+    SUCCESS = "success"
+    FAILOVER = "failover"
+    ERROR = "error"
+
+
+class LLMUsageGroup(StrEnum):
+    JOB = "job"
+    AGENT = "agent"
+    MODEL = "model"
+    DAY = "day"
+
+
 class JobType(StrEnum):
     FULL_TIME = "full-time"
     PART_TIME = "part-time"
@@ -37,10 +105,20 @@ class Job(base.BigIntAuditBase):
     job_description: Mapped[str] = mapped_column(type_=TEXT)
     job_requirements: Mapped[str] = mapped_column(type_=TEXT)
     job_contact_email: Mapped[str] = mapped_column()
+    default_agent_id: Mapped[int] = mapped_column(ForeignKey("agent.id", ondelete="SET NULL"), nullable=True)
+    job_embedding: Mapped[list[float]] = mapped_column(Vector(EMBEDDING_DIMENSIONS), nullable=True, deferred=True)
 
 
 class Candidate(base.BigIntAuditBase):
     __tablename__ = "candidate"
+    __table_args__ = (
+        Index(
+            "ix_candidate_embedding",
+            "candidate_embedding",
+            postgresql_using="hnsw",
+            postgresql_ops={"candidate_embedding": "vector_cosine_ops"},
+        ),
+    )
 
     candidate_name: Mapped[str] = mapped_column()
     candidate_email: Mapped[str] = mapped_column()
@@ -52,19 +130,85 @@ class Candidate(base.BigIntAuditBase):
     candidate_github: Mapped[str] = mapped_column()
     candidate_portfolio: Mapped[str] = mapped_column()
     data_processed: Mapped[bool] = mapped_column(default=False)
+    processing_started_at: Mapped[datetime] = mapped_column(nullable=True)
+    # claims since the last successful enrichment, the candidate is no longer claimed after ENRICHMENT_MAX_ATTEMPTS
+    processing_attempts: Mapped[int] = mapped_column(default=0, server_default="0")
     # metadata
     candidate_image: Mapped[str] = mapped_column(nullable=True)
     candidate_resume_data: Mapped[str] = mapped_column(type_=TEXT, nullable=True)
     candidate_linkedin_data: Mapped[str] = mapped_column(type_=TEXT, nullable=True)
     candidate_github_data: Mapped[str] = mapped_column(type_=TEXT, nullable=True)
     candidate_portfolio_data: Mapped[str] = mapped_column(type_=TEXT, nullable=True)
+    candidate_embedding: Mapped[list[float]] = mapped_column(Vector(EMBEDDING_DIMENSIONS), nullable=True, deferred=True)
 
 
 class JobApplication(base.BigIntAuditBase):
     __tablename__ = "job_application"
-    __table_args__ = (UniqueConstraint("job_id", "candidate_id", name="unique_job_application"),)
+    __table_args__ = (
+        UniqueConstraint("job_id", "candidate_id", name="unique_job_application"),
+        Index("ix_job_application_created", "created_at", "id"),
+        Index("ix_job_application_job_created", "job_id", "created_at", "id"),
+    )
 
     job_id: Mapped[int] = mapped_column(ForeignKey("job.id", ondelete="CASCADE"), index=True)
     candidate_id: Mapped[int] = mapped_column(ForeignKey("candidate.id", ondelete="CASCADE"), index=True)
-    candidate_skills: Mapped[str] = mapped_column(nullable=True)
+    candidate_skills: Mapped[list[str]] = mapped_column(JSONB, nullable=True)
     candidate_summary: Mapped[str] = mapped_column(nullable=True)
+
+
+class FitScore(base.BigIntAuditBase):
+    __tablename__ = "fit_score"
+    __table_args__ = (
+        UniqueConstraint("job_application_id", "agent_id", "genai_model", name="unique_fit_score"),
+        Index("ix_fit_score_ranking", "job_id", "agent_id", "genai_model", "score"),
+    )
+
+    job_id: Mapped[int] = mapped_column(ForeignKey("job.id", ondelete="CASCADE"))
+    job_application_id: Mapped[int] = mapped_column(ForeignKey("job_application.id", ondelete="CASCADE"))
+    agent_id: Mapped[int] = mapped_column(ForeignKey("agent.id", ondelete="CASCADE"), index=True)
+    genai_model: Mapped[GenAIModel] = mapped_column()
+    input_hash: Mapped[str] = mapped_column()
+    # null when scoring this input_hash failed, retried after SCORING_FAILURE_RETRY_AFTER
+    score: Mapped[int] = mapped_column(nullable=True)
+
+
+class GitHubResponse(base.BigIntAuditBase):
+    __tablename__ = "github_response"
+
+    url: Mapped[str] = mapped_column(type_=TEXT, unique=True)
+    etag: Mapped[str] = mapped_column(nullable=True)
+    link: Mapped[str] = mapped_column(type_=TEXT, nullable=True)
+    body: Mapped[str] = mapped_column(type_=TEXT)
+
+
+class ResumeText(base.BigIntAuditBase):
+    __tablename__ = "resume_text"
+
+    content_key: Mapped[str] = mapped_column(unique=True)
+    resume_text: Mapped[str] = mapped_column(type_=TEXT)
+    size: Mapped[int] = mapped_column(type_=BigInteger)
+    hits: Mapped[int] = mapped_column(default=0)
+    # lookups that found no entry, concurrent first lookups of the same resume each count
+    misses: Mapped[int] = mapped_column(default=0)
+
+
+class LLMCall(base.BigIntAuditBase):
+    __tablename__ = "llm_call"
+    __table_args__ = (
+        Index("ix_llm_call_created", "created_at"),
+        Index("ix_llm_call_job_created", "job_id", "created_at"),
+    )
+
+    # the model that answered, which is the failover model after a failover
+    genai_model: Mapped[GenAIModel] = mapped_column()
+    requested_model: Mapped[GenAIModel] = mapped_column()
+    purpose: Mapped[LLMPurpose] = mapped_column()
+    outcome: Mapped[LLMCallOutcome] = mapped_column()
+    # no foreign keys, the ledger keeps the calls of deleted jobs and candidates
+    job_id: Mapped[int] = mapped_column(type_=BigInteger, nullable=True)
+    agent_id: Mapped[int] = mapped_column(type_=BigInteger, nullable=True)
+    candidate_id: Mapped[int] = mapped_column(type_=BigInteger, nullable=True)
+    input_tokens: Mapped[int] = mapped_column()
+    output_tokens: Mapped[int] = mapped_column()
+    latency_ms: Mapped[float] = mapped_column(type_=Float)
+    retries: Mapped[int] = mapped_column()
@@ -12,6 +12,17 @@ class JobCreate(Struct):
     job_description: str
     job_requirements: str
     job_contact_email: str
+    default_agent_id: int | None = None
+
+
+class JobUpdate(Struct):
+    job_title: str
+    job_location: str
+    job_type: JobType
+    job_description: str
+    job_requirements: str
+    job_contact_email: str
+    default_agent_id: int | None = None
 
 
 class JobResponse(Struct):
@@ -21,6 +32,7 @@ class JobResponse(Struct):
     job_description: str
     job_requirements: str
     job_contact_email: str
+    default_agent_id: int | None
     id: int
     created_at: datetime
     updated_at: datetime
@@ -1,6 +1,7 @@
 from datetime import datetime
+from typing import Annotated
 
-from msgspec import Struct
+from msgspec import Meta, Struct
 
 
 class CandidateCreate(Struct):
@@ -27,13 +28,36 @@ class CandidateUpdate(Struct):
 class JobApplicationsResponse(Struct):
     job_id: int
     candidate_id: int
-    candidate_skills: str | None
+    candidate_skills: list[str] | None
     candidate_summary: str | None
     id: int
     created_at: datetime
     updated_at: datetime
 
 
+class JobApplicationsPage(Struct):
+    items: list[JobApplicationsResponse]
+    next_cursor: str | None
+
+
 class JobApplicationUpdate(Struct):
-    candidate_skills: str | None = None
+    candidate_skills: list[str] | None = None
     candidate_summary: str | None = None
+
+
+class CandidateScore(Struct):
+    id: int
+    score: Annotated[int, Meta(ge=0, le=100)]
+
+
+class CandidateScores(Struct):
+    scores: list[CandidateScore]
+
+
+class CandidateProfile(Struct):
+    skills: list[str]
+    summary: str
+
+
+class SignedUrlsRequest(Struct):
+    blob_names: Annotated[list[str], Meta(min_length=1, max_length=100)]
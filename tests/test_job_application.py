@@ -0,0 +1,109 @@
+import unittest
+import uuid
+
+from litestar import Litestar, status_codes
+from litestar.di import Provide
+from litestar.plugins.sqlalchemy import SQLAlchemyPlugin
+from litestar.testing import AsyncTestClient
+from litestar_saq import TaskQueues
+from saq import Queue
+from sqlalchemy import delete, insert, select
+
+from benchmarks.fakes import FakeQueue
+from config import DB_CONFIG
+from controllers.job_application import JobApplicationController
+from models import Candidate, Job, JobApplication
+
+
+class UpdateCandidateTest(unittest.IsolatedAsyncioTestCase):
+    # runs against the database from the environment, like the benchmark
+    async def asyncSetUp(self) -> None:
+        self.queue = FakeQueue()
+        self.app = Litestar(
+            route_handlers=[JobApplicationController],
+            plugins=[SQLAlchemyPlugin(DB_CONFIG)],
+            dependencies={
+                "task_queues": Provide(
+                    lambda: TaskQueues(queues={"candidate_data_processing": self.queue}),  # type: ignore
+                    sync_to_thread=False,
+                ),
+            },
+            signature_types=[Queue, TaskQueues],
+        )
+
+        async with DB_CONFIG.get_engine().begin() as connection:
+            await connection.run_sync(Candidate.metadata.create_all)
+
+        run_id = uuid.uuid4().hex
+        async with DB_CONFIG.get_session() as db_session, db_session.begin():
+            self.job_id = await db_session.scalar(
+                insert(Job)
+                .values(
+                    job_title="Backend Engineer",
+                    job_location="Remote",
+                    job_description="Build services.",
+                    job_requirements="Python",
+                    job_contact_email="jobs@example.com",
+                )
+                .returning(Job.id),
+            )
+            self.candidate_id = await db_session.scalar(
+                insert(Candidate)
+                .values(
+                    candidate_name="Candidate",
+                    candidate_email="candidate@example.com",
+                    candidate_phone="000",
+                    candidate_current_role="Software Engineer",
+                    candidate_current_yoe=3,
+                    candidate_resume_id=f"test/{run_id}.pdf",
+                    candidate_linkedin="",
+                    candidate_github="",
+                    candidate_portfolio="",
+                    data_processed=True,
+                )
+                .returning(Candidate.id),
+            )
+            await db_session.execute(insert(JobApplication).values(job_id=self.job_id, candidate_id=self.candidate_id))
+
+    async def asyncTearDown(self) -> None:
+        async with DB_CONFIG.get_session() as db_session, db_session.begin():
+            await db_session.execute(delete(Job).where(Job.id == self.job_id))
+            await db_session.execute(delete(Candidate).where(Candidate.id == self.candidate_id))
+        await DB_CONFIG.get_engine().dispose()
+
+    async def test_update_candidate(self) -> None:
+        async with AsyncTestClient(self.app) as client:
+            response = await client.put(
+                f"/job-applications/candidate/{self.candidate_id}",
+                json={"data_processed": True, "candidate_resume_data": "Python services"},
+            )
+
+        assert response.status_code == status_codes.HTTP_200_OK
+        assert response.json()["status"] == "success"
+
+        async with DB_CONFIG.get_session() as db_session:
+            candidate = await db_session.scalar(select(Candidate).where(Candidate.id == self.candidate_id))
+
+        assert candidate is not None
+        assert candidate.candidate_resume_data == "Python services"
+        assert f"precompute_job_scores:{self.job_id}:None:None" in [job["key"] for job in self.queue.enqueued]
+
+    async def test_update_candidate_not_processed(self) -> None:
+        async with AsyncTestClient(self.app) as client:
+            response = await client.put(
+                f"/job-applications/candidate/{self.candidate_id}",
+                json={"data_processed": False},
+            )
+
+        assert response.status_code == status_codes.HTTP_200_OK
+        assert self.queue.enqueued == []
+
+    async def test_update_missing_candidate(self) -> None:
+        async with AsyncTestClient(self.app) as client:
+            response = await client.put("/job-applications/candidate/0", json={"data_processed": True})
+
+        assert response.status_code == status_codes.HTTP_404_NOT_FOUND
+
+
+if __name__ == "__main__":
+    unittest.main()
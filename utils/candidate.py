@@ -1,149 +1,356 @@
-import os
-from contextlib import suppress
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import UTC, datetime, timedelta
+from functools import cache
 
-import httpx
-import pymupdf
-from crawl4ai import AsyncWebCrawler, CacheMode, CrawlerRunConfig
-from google.cloud import storage
+import msgspec
 from saq.types import Context
-from sqlalchemy import select
-from usp.tree import sitemap_tree_for_homepage
-
-from config import DB_CONFIG, GENERATION_CONFIG, GOOGLE_GENAI
-from models import Candidate
-from utils.github_parse import process_github
-
-RUN_CONFIG = CrawlerRunConfig(
-    cache_mode=CacheMode.BYPASS,
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import (
+    DB_CONFIG,
+    EMBEDDING_BATCH_SIZE,
+    ENRICHMENT_BATCH_SIZE,
+    ENRICHMENT_CONCURRENCY,
+    ENRICHMENT_GENAI_MODEL,
+    ENRICHMENT_LEASE_SECONDS,
+    ENRICHMENT_MAX_ATTEMPTS,
+    PORTFOLIO_LLM_CLEANUP,
+    RESUME_CACHE_MAX_AGE,
+    RESUME_MAX_BYTES,
+    RESUME_MAX_PAGES,
+    RESUME_PAGES_PER_WORKER,
+    RESUME_PARSE_WORKERS,
 )
-
-
-SYSTEM_INSTRUCTION_CHAT = "**SYSTEM:** You are an advanced HTML data processor. Your task is to analyze the provided HTML content and extract the candidates information. It is a portfolio website data. Extract the text content from the tags. Do not include HTML tags in the extracted text and only remove the Image or Href links. I want as much data as possibale. Generate output in Markdown"
-
-
-async def process_portfolio(url: str) -> str:
-    data = []
-    tree = sitemap_tree_for_homepage(url).all_pages()
-
-    async with AsyncWebCrawler() as crawler:
-        for page in tree:
-            result = await crawler.arun(
-                url=page.url,
-                config=RUN_CONFIG,
+from models import Candidate, FitScore, GenAIModel, JobApplication, LLMPurpose, ResumeText
+from schema.job_application import CandidateProfile
+from utils.embedding import embed_pending_candidates, embed_pending_jobs
+from utils.github_parse import GitHubRateLimitError, process_github
+from utils.ledger import LLMCallContext
+from utils.llm import LLMOutput, generate
+from utils.metrics import record_cache, timed
+from utils.pdf import extract_pages
+from utils.portfolio import process_portfolio
+from utils.prompt import build_candidate_prompt
+from utils.scoring import enqueue_precompute, enqueue_scored_pairs
+from utils.storage import get_bucket
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_INSTRUCTION_PROFILE = '**SYSTEM:** Your task is to analyze the provided candidate information and generate the skills and a summary of the candidate. Reply with only a JSON object of the form {"skills": ["..."], "summary": "..."}, where skills is a list of maximum 10 skills, for example: ["Python", "Java", "AWS", "Docker", "Kubernetes"]. Skills can be non-technical as well. The summary must only describe the candidate, for example: \'Candidate is a Python Developer with 5 years of experience in Django and Flask, they are also contributing to open-source projects in their free time.\'. Do not add any extra information.'
+
+SYSTEM_INSTRUCTION_CHAT = "**SYSTEM:** You are an advanced portfolio data processor. Your task is to analyze the provided Markdown content extracted from the pages of a candidate's portfolio website and keep the candidates information. Remove any leftover navigation, boilerplate or unrelated text. I want as much data about the candidate as possible. Generate output in Markdown"
+
+
+@cache
+def get_pdf_executor() -> ProcessPoolExecutor:
+    # PyMuPDF is not thread safe, pages are parsed in worker processes instead of threads
+    return ProcessPoolExecutor(max_workers=RESUME_PARSE_WORKERS)
+
+
+async def shutdown_pdf_executor(_: Context) -> None:
+    get_pdf_executor().shutdown(cancel_futures=True)
+    get_pdf_executor.cache_clear()
+
+
+async def extract_pdf_text(stream: bytes) -> str:
+    loop = asyncio.get_running_loop()
+    executor = get_pdf_executor()
+
+    # the first chunk also reports the page count, the rest of the pages are split across the pool
+    text, page_count = await loop.run_in_executor(
+        executor,
+        extract_pages,
+        stream,
+        0,
+        RESUME_PAGES_PER_WORKER,
+        RESUME_MAX_PAGES,
+    )
+    page_count = min(page_count, RESUME_MAX_PAGES)
+
+    chunks = await asyncio.gather(
+        *(
+            loop.run_in_executor(
+                executor,
+                extract_pages,
+                stream,
+                start,
+                start + RESUME_PAGES_PER_WORKER,
+                RESUME_MAX_PAGES,
             )
+            for start in range(RESUME_PAGES_PER_WORKER, page_count, RESUME_PAGES_PER_WORKER)
+        ),
+    )
 
-            if result.success:
-                data.append(f"URL: {page.url}\n HTML: {result.html}\n")
+    return "".join([text, *(chunk for chunk, _ in chunks)])
 
-    return "\n".join(data)
 
+async def process_resume(source_blob_name: str) -> str | None:
+    blob = await asyncio.to_thread(get_bucket().get_blob, source_blob_name)
 
-async def process_resume(source_blob_name: str) -> str:
-    storage_client = storage.Client()
-    bucket = storage_client.bucket("nexus-genai25")
-    blob = bucket.blob(source_blob_name)
+    if blob is None:
+        msg = f"Resume {source_blob_name} not found"
+        raise ValueError(msg)
 
-    path = f"./data/{source_blob_name}"
-
-    blob.download_to_filename(path)
+    if blob.size is not None and blob.size > RESUME_MAX_BYTES:
+        logger.warning(
+            "Skipping resume %s: %s bytes exceeds the %s byte cap",
+            source_blob_name,
+            blob.size,
+            RESUME_MAX_BYTES,
+        )
+        return None
 
-    data = ""
-    with pymupdf.open(path) as document:
-        for page in document:
-            text = page.get_text()  # type: ignore
-            data += text
+    # identical uploads share an md5, composite objects without one fall back to name and generation
+    content_key = f"md5:{blob.md5_hash}" if blob.md5_hash else f"generation:{blob.name}#{blob.generation}"
 
-    os.remove(path)
+    async with DB_CONFIG.get_session() as db_session:
+        resume_text = await db_session.scalar(
+            update(ResumeText)
+            .where(ResumeText.content_key == content_key)
+            .values(hits=ResumeText.hits + 1)
+            .returning(ResumeText.resume_text),
+        )
+        await db_session.commit()
 
-    return data
+    record_cache("resume", hit=resume_text is not None)
+    if resume_text is not None:
+        logger.info("Resume cache hit for %s, skipped %s bytes", source_blob_name, blob.size)
+        return resume_text
 
+    with timed("resume.download"):
+        stream = await asyncio.to_thread(blob.download_as_bytes)
+    with timed("resume.parse"):
+        resume_text = await extract_pdf_text(stream)
 
-async def process_candidate(_: Context) -> None:
     async with DB_CONFIG.get_session() as db_session:
-        candidates = await db_session.scalars(select(Candidate).where(Candidate.data_processed == False))
-        candidates = list(candidates)
-
-    for candidate in candidates:
-        model_chat = GOOGLE_GENAI.GenerativeModel(  # type: ignore
-            model_name="gemini-1.5-flash-8b",
-            generation_config=GENERATION_CONFIG,
-            system_instruction=SYSTEM_INSTRUCTION_CHAT,
+        await db_session.execute(
+            insert(ResumeText)
+            .values(content_key=content_key, resume_text=resume_text, size=len(stream), hits=0, misses=1)
+            .on_conflict_do_update(
+                index_elements=[ResumeText.content_key],
+                set_={"misses": ResumeText.misses + 1},
+            ),
         )
+        await db_session.commit()
 
-        async with DB_CONFIG.get_session() as db_session:
-            response = None
-            if candidate.candidate_portfolio:
-                candidate_portfolio_data = await process_portfolio(candidate.candidate_portfolio)
-                chat_session = model_chat.start_chat()
-                response = await chat_session.send_message_async(candidate_portfolio_data)
-                response = response.text
-
-            github = None
-            if candidate.candidate_github:
-                github = await process_github(candidate.candidate_github)
-
-            linkedin = None
-            if candidate.candidate_linkedin:
-                print("Processing Linkedin")
-
-            resume = None
-            if candidate.candidate_resume_id:
-                resume = await process_resume(candidate.candidate_resume_id)
-
-            data = f"**RESUME:** {resume}\n\n\n\n**LINKEDIN:** {linkedin}\n\n\n\n**GITHUB:** {github}\n\n\n\n**PORTFOLIO:** {response}"
-
-            # Skills
-            system_instruction_skills = "**SYSTEM:** Your task is to analyze the provided candidate information and generate a valid python list of skills, for example: ['Python', 'Java', 'AWS', 'Docker', 'Kubernetes']. You can use the provided candidate information to generate the skills list.**SYSTEM:** Keep in mind that you can only reply with maximum 10 skills and do not add any extra information. Example: ['Python', 'Java', 'AWS', 'Docker', 'Kubernetes']. Do not do any formatting or add any special characters. Skills can be non-technical as well."
-
-            model_skills = GOOGLE_GENAI.GenerativeModel(  # type: ignore
-                model_name="gemini-1.5-flash-8b",
-                generation_config=GENERATION_CONFIG,
-                system_instruction=system_instruction_skills,
-            )
+    return resume_text
 
-            chat_session_skills = model_skills.start_chat()
 
-            response_skills = await chat_session_skills.send_message_async(
-                data,
+async def evict_resume_cache(_: Context) -> None:
+    # a hit bumps updated_at, so only resumes nobody looked up for RESUME_CACHE_MAX_AGE are dropped
+    async with DB_CONFIG.get_session() as db_session:
+        await db_session.execute(
+            delete(ResumeText).where(
+                ResumeText.updated_at < datetime.now(UTC) - timedelta(seconds=RESUME_CACHE_MAX_AGE),
+            ),
+        )
+        await db_session.commit()
+
+
+async def save_candidate_enrichment(  # noqa: PLR0913
+    db_session: AsyncSession,
+    candidate_id: int,
+    *,
+    resume: str | None,
+    linkedin: str | None,
+    github: str | None,
+    portfolio: str | None,
+    skills: list[str],
+    summary: str | None,
+) -> list[int]:
+    # written in the caller's transaction so a candidate is never marked processed without its summary
+    await db_session.execute(
+        update(Candidate)
+        .where(Candidate.id == candidate_id)
+        .values(
+            data_processed=True,
+            processing_attempts=0,
+            candidate_resume_data=resume,
+            candidate_linkedin_data=linkedin,
+            candidate_github_data=github,
+            candidate_portfolio_data=portfolio,
+            candidate_embedding=None,
+        ),
+    )
+
+    job_ids = await db_session.scalars(
+        update(JobApplication)
+        .where(JobApplication.candidate_id == candidate_id)
+        .values(candidate_skills=skills, candidate_summary=summary)
+        .returning(JobApplication.job_id),
+    )
+
+    return list(job_ids)
+
+
+async def enrich_candidate(ctx: Context, candidate: Candidate) -> None:
+    genai_model = GenAIModel(ENRICHMENT_GENAI_MODEL)
+
+    response = None
+    if candidate.candidate_portfolio:
+        with timed("enrichment.portfolio"):
+            response = await process_portfolio(candidate.candidate_portfolio)
+
+        # the crawler already produces markdown, the model pass only tidies what the local reduction left behind
+        if PORTFOLIO_LLM_CLEANUP and response:
+            with timed("enrichment.portfolio_cleanup"):
+                cleanup = await generate(
+                    genai_model,
+                    SYSTEM_INSTRUCTION_CHAT,
+                    response,
+                    call=LLMCallContext(LLMPurpose.PORTFOLIO_CLEAN, candidate_id=candidate.id),
+                )
+            logger.info(
+                "Portfolio cleanup for candidate %s: %s tokens in, %s tokens out",
+                candidate.id,
+                cleanup.input_tokens,
+                cleanup.output_tokens,
             )
+            response = cleanup.text or response
+
+    github = None
+    if candidate.candidate_github:
+        with timed("enrichment.github"):
+            github = await process_github(candidate.candidate_github)
+
+    linkedin = None
+    if candidate.candidate_linkedin:
+        print("Processing Linkedin")
+
+    resume = None
+    if candidate.candidate_resume_id:
+        with timed("enrichment.resume"):
+            resume = await process_resume(candidate.candidate_resume_id)
+
+    data = build_candidate_prompt(
+        genai_model,
+        resume=resume,
+        linkedin=linkedin,
+        github=github,
+        portfolio=response,
+    )
+
+    # one structured call returns both the skills and the summary
+    with timed("enrichment.profile"):
+        response_profile = await generate(
+            genai_model,
+            SYSTEM_INSTRUCTION_PROFILE,
+            data,
+            LLMOutput.PROFILE,
+            call=LLMCallContext(LLMPurpose.PROFILE, candidate_id=candidate.id),
+        )
 
-            skills = []
-            if response_skills.text:
-                with suppress(ValueError):
-                    skills = eval(response_skills.text)
+    # raised rather than saved without a summary, the candidate stays unprocessed and is retried once its lease expires
+    try:
+        profile = msgspec.json.decode(response_profile.text or "", type=CandidateProfile)
+    except (msgspec.DecodeError, ValueError) as e:
+        msg = f"Invalid profile reply for candidate {candidate.id}"
+        raise ValueError(msg) from e
+
+    if not profile.summary.strip():
+        msg = f"Empty summary in the profile reply for candidate {candidate.id}"
+        raise ValueError(msg)
+
+    with timed("enrichment.save"):
+        async with DB_CONFIG.get_session() as db_session, db_session.begin():
+            job_ids = await save_candidate_enrichment(
+                db_session,
+                candidate.id,
+                resume=resume,
+                linkedin=linkedin,
+                github=github,
+                portfolio=response,
+                skills=profile.skills[:10],
+                summary=profile.summary,
+            )
 
-            # Summary
-            system_instruction_summary = "**SYSTEM:** Your task is to analyze the provided candidate information and generate a summary of the candidate. You can use the provided candidate information to generate the summary.**SYSTEM:** Keep in mind that you can only reply with a summary of the candidate do not add any extra information. Example: 'Candidate is a Python Developer with 5 years of experience in Django and Flask, they are also contributing to open-source projects in their free time.'."
+    queue = ctx["worker"].queue
+    for job_id in job_ids:
+        await enqueue_precompute(queue, job_id)
+    if job_ids:
+        async with DB_CONFIG.get_session() as db_session:
+            await enqueue_scored_pairs(db_session, queue, FitScore.job_id.in_(job_ids))
+
+
+async def claim_candidates(limit: int) -> list[Candidate]:
+    # a lease older than ENRICHMENT_LEASE_SECONDS belongs to a crashed or timed out worker and can be reclaimed,
+    # a candidate that keeps failing stops being claimed after ENRICHMENT_MAX_ATTEMPTS
+    claimable = (
+        select(Candidate.id)
+        .where(
+            Candidate.data_processed == False,
+            Candidate.processing_attempts < ENRICHMENT_MAX_ATTEMPTS,
+            or_(
+                Candidate.processing_started_at.is_(None),
+                Candidate.processing_started_at < func.now() - timedelta(seconds=ENRICHMENT_LEASE_SECONDS),
+            ),
+        )
+        .order_by(Candidate.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
 
-            model_summary = GOOGLE_GENAI.GenerativeModel(  # type: ignore
-                model_name="gemini-1.5-flash-8b",
-                generation_config=GENERATION_CONFIG,
-                system_instruction=system_instruction_summary,
-            )
+    async with DB_CONFIG.get_session() as db_session:
+        candidates = await db_session.scalars(
+            update(Candidate)
+            .where(Candidate.id.in_(claimable.scalar_subquery()))
+            .values(processing_started_at=func.now(), processing_attempts=Candidate.processing_attempts + 1)
+            .returning(Candidate)
+            .execution_options(synchronize_session=False),
+        )
+        candidates = list(candidates)
+        # detached before the commit so the claimed rows are not expired
+        db_session.expunge_all()
+        await db_session.commit()
 
-            chat_session_summary = model_summary.start_chat()
+    return candidates
 
-            response_summary = await chat_session_summary.send_message_async(
-                data,
-            )
 
-            summary = response_summary.text
-
-            async with httpx.AsyncClient() as client:
-                data = {
-                    "data_processed": True,
-                    "candidate_resume_data": resume,
-                    "candidate_linkedin_data": linkedin,
-                    "candidate_github_data": github,
-                    "candidate_portfolio_data": response,
-                }
-                await client.put(f"http://127.0.0.1:8621/job-applications/candidate/{candidate.id}", json=data)
-
-                job_application = await client.get(f"http://127.0.0.1:8621/job-applications/{candidate.id}")
-                job_application = job_application.json()
-
-                data = {
-                    "candidate_skills": str(skills),
-                    "candidate_summary": summary,
-                }
-                await client.put(f"http://127.0.0.1:8621/job-applications/{job_application['id']}", json=data)
+async def release_attempt(candidate_id: int) -> None:
+    async with DB_CONFIG.get_session() as db_session:
+        await db_session.execute(
+            update(Candidate)
+            .where(Candidate.id == candidate_id)
+            .values(processing_attempts=func.greatest(Candidate.processing_attempts - 1, 0)),
+        )
+        await db_session.commit()
+
+
+async def process_candidate(ctx: Context) -> None:
+    candidates = await claim_candidates(ENRICHMENT_BATCH_SIZE)
+    semaphore = asyncio.Semaphore(ENRICHMENT_CONCURRENCY)
+
+    async def process(candidate: Candidate) -> None:
+        async with semaphore:
+            try:
+                with timed("enrichment.candidate"):
+                    await enrich_candidate(ctx, candidate)
+            except GitHubRateLimitError as e:
+                # deferred rather than enriched with a partial profile, the lease expiry retries it without
+                # counting the claim as a failed attempt
+                logger.warning("Deferring candidate %s: %s", candidate.id, e)
+                await release_attempt(candidate.id)
+            except Exception:
+                # the lease is kept, so the candidate is retried once it expires
+                logger.exception("Failed to process candidate %s", candidate.id)
+                if candidate.processing_attempts >= ENRICHMENT_MAX_ATTEMPTS:
+                    logger.warning(
+                        "Giving up on candidate %s after %s attempts",
+                        candidate.id,
+                        candidate.processing_attempts,
+                    )
+
+    await asyncio.gather(*(process(candidate) for candidate in candidates))
+
+    # profiles enriched in this pass are embedded together, along with any left over by earlier passes
+    try:
+        with timed("enrichment.embed"):
+            async with DB_CONFIG.get_session() as db_session, db_session.begin():
+                await embed_pending_jobs(db_session, EMBEDDING_BATCH_SIZE)
+                await embed_pending_candidates(db_session, EMBEDDING_BATCH_SIZE)
+    except Exception:
+        logger.exception("Failed to embed candidate profiles")
@@ -0,0 +1,145 @@
+from typing import Any
+
+from sqlalchemy import Select, func, select, true, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import EMBEDDING_BATCH_SIZE, EMBEDDING_MODEL
+from models import Candidate, Job, JobApplication
+from utils.llm import LLM_GATEWAY
+
+# pgvector's default hnsw.ef_search and the largest value it accepts
+HNSW_EF_SEARCH = 40
+HNSW_MAX_EF_SEARCH = 1000
+
+
+def build_job_text(job: Job) -> str:
+    return f"{job.job_title}\n\n{job.job_description}\n\n{job.job_requirements}"
+
+
+def build_candidate_text(candidate: Candidate, skills: list[str] | None, summary: str | None) -> str:
+    # the embedding model truncates long inputs, the compact profile goes first
+    return "\n\n".join(
+        str(part)
+        for part in (
+            candidate.candidate_current_role,
+            f"{candidate.candidate_current_yoe} years of experience",
+            ", ".join(skills or []),
+            summary,
+            candidate.candidate_resume_data,
+            candidate.candidate_github_data,
+            candidate.candidate_portfolio_data,
+        )
+        if part
+    )
+
+
+async def embed_texts(texts: list[str], input_type: str) -> list[list[float]]:
+    embeddings: list[list[float]] = []
+
+    # one request per EMBEDDING_BATCH_SIZE texts, the most the embed endpoint accepts at once
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        embeddings.extend(
+            await LLM_GATEWAY.embed(EMBEDDING_MODEL, texts[start : start + EMBEDDING_BATCH_SIZE], input_type),
+        )
+
+    return embeddings
+
+
+async def embed_pending_candidates(db_session: AsyncSession, limit: int) -> int:
+    result = await db_session.execute(
+        select(Candidate, JobApplication.candidate_skills, JobApplication.candidate_summary)
+        .outerjoin(JobApplication, JobApplication.candidate_id == Candidate.id)
+        .where(Candidate.data_processed.is_(True), Candidate.candidate_embedding.is_(None))
+        .distinct(Candidate.id)
+        .order_by(Candidate.id)
+        .limit(limit),
+    )
+    rows = list(result)
+    if not rows:
+        return 0
+
+    embeddings = await embed_texts(
+        [build_candidate_text(candidate, skills, summary) for candidate, skills, summary in rows],
+        "search_document",
+    )
+
+    await db_session.execute(
+        update(Candidate),
+        [
+            {"id": candidate.id, "candidate_embedding": embedding}
+            for (candidate, _, _), embedding in zip(rows, embeddings, strict=True)
+        ],
+    )
+
+    return len(rows)
+
+
+async def embed_pending_jobs(db_session: AsyncSession, limit: int) -> int:
+    jobs = list(await db_session.scalars(select(Job).where(Job.job_embedding.is_(None)).order_by(Job.id).limit(limit)))
+    if not jobs:
+        return 0
+
+    embeddings = await embed_texts([build_job_text(job) for job in jobs], "search_query")
+
+    await db_session.execute(
+        update(Job),
+        [{"id": job.id, "job_embedding": embedding} for job, embedding in zip(jobs, embeddings, strict=True)],
+    )
+
+    return len(jobs)
+
+
+async def get_job_embedding(db_session: AsyncSession, job: Job) -> list[float]:
+    embedding = await db_session.scalar(select(Job.job_embedding).where(Job.id == job.id))
+
+    # jobs created or edited since the last worker pass are embedded on first use
+    if embedding is None:
+        [embedding] = await embed_texts([build_job_text(job)], "search_query")
+        await db_session.execute(update(Job).where(Job.id == job.id).values(job_embedding=embedding))
+
+    return embedding
+
+
+async def prepare_shortlist_scan(db_session: AsyncSession, limit: int) -> None:
+    # the HNSW index covers every candidate and the job filter runs on what it returns, a plain index scan
+    # stops after ef_search neighbours, the iterative scan keeps reading until limit applicants of the job are found,
+    # ef_search is raised for large limits to keep recall up, both only last for the current transaction
+    ef_search = max(HNSW_EF_SEARCH, min(limit, HNSW_MAX_EF_SEARCH))
+    await db_session.execute(select(func.set_config("hnsw.iterative_scan", "strict_order", true())))
+    await db_session.execute(select(func.set_config("hnsw.ef_search", str(ef_search), true())))
+
+
+def build_shortlist_query(job_id: int, embedding: list[float], limit: int) -> Select[Any]:
+    # ordered by the distance alone so the HNSW index can serve it, run after prepare_shortlist_scan
+    distance = Candidate.candidate_embedding.cosine_distance(embedding)
+    return (
+        select(JobApplication.id, distance.label("distance"))
+        .join(Candidate, JobApplication.candidate_id == Candidate.id)
+        .where(JobApplication.job_id == job_id, Candidate.candidate_embedding.is_not(None))
+        .order_by(distance)
+        .limit(limit)
+    )
+
+
+def build_shortlist_read_query(job_id: int, embedding: list[float], limit: int) -> Select[Any]:
+    shortlist = build_shortlist_query(job_id, embedding, limit).subquery()
+    return (
+        select(
+            JobApplication.id,
+            Candidate.candidate_name,
+            Candidate.candidate_email,
+            Candidate.candidate_phone,
+            Candidate.candidate_current_yoe,
+            Candidate.candidate_current_role,
+            Candidate.candidate_resume_id,
+            Candidate.data_processed,
+            Candidate.candidate_image,
+            JobApplication.created_at,
+            JobApplication.candidate_summary,
+            JobApplication.candidate_skills,
+            shortlist.c.distance,
+        )
+        .join(shortlist, shortlist.c.id == JobApplication.id)
+        .join(Candidate, JobApplication.candidate_id == Candidate.id)
+        .order_by(shortlist.c.distance, JobApplication.id)
+    )
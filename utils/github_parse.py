@@ -1,15 +1,206 @@
+import asyncio
 import base64
-from datetime import datetime, timedelta
+import importlib.util
+import time
+from collections.abc import Coroutine
+from contextlib import suppress
+from datetime import UTC, date, datetime, timedelta
+from functools import cache
 from typing import Any
 
 import httpx
+from saq.types import Context
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.postgresql import insert
 
 # Replace with your GitHub username and Personal Access Token (if needed)
-from config import GITHUB_TOKEN
+from config import (
+    DB_CONFIG,
+    GITHUB_CACHE_MAX_AGE,
+    GITHUB_CACHE_TTL,
+    GITHUB_CONCURRENCY,
+    GITHUB_DEADLINE,
+    GITHUB_RATE_LIMIT_MAX_WAIT,
+    GITHUB_RATE_LIMIT_RESERVE,
+    GITHUB_RATE_LIMIT_SLOWDOWN,
+    GITHUB_TOKEN,
+)
+from models import GitHubResponse
+from utils.metrics import record_cache, timed, timed_stage
 
 BASE_URL = "https://api.github.com"
 
+OK = 200
+NOT_MODIFIED = 304
+FORBIDDEN = 403
+TOO_MANY_REQUESTS = 429
 
+GITHUB_SEMAPHORE = asyncio.Semaphore(GITHUB_CONCURRENCY)
+
+COMMIT_COUNT_CACHE_SIZE = 4096
+COMMIT_COUNT_CACHE: dict[tuple[str, str, str, date], int] = {}
+
+
+@cache
+def get_github_client() -> httpx.AsyncClient:
+    # one keep-alive pool per worker process instead of a TLS handshake per request, multiplexed when h2 is installed
+    return httpx.AsyncClient(
+        http2=importlib.util.find_spec("h2") is not None,
+        timeout=httpx.Timeout(15.0),
+        limits=httpx.Limits(max_connections=GITHUB_CONCURRENCY, max_keepalive_connections=GITHUB_CONCURRENCY),
+    )
+
+
+async def close_github_client(_: Context) -> None:
+    await get_github_client().aclose()
+    get_github_client.cache_clear()
+
+
+class GitHubRateLimitError(Exception):
+    def __init__(self, reset_at: float) -> None:  # noqa: D107
+        super().__init__(f"GitHub rate limit exhausted until {datetime.fromtimestamp(reset_at, UTC).isoformat()}")
+        self.reset_at = reset_at
+
+
+class GitHubRateLimit:
+    # quota as last reported by the X-RateLimit-* headers of this worker process
+    def __init__(self) -> None:  # noqa: D107
+        self.remaining: int | None = None
+        self.reset_at = 0.0
+        # the next free request slot when slowing down, shared so concurrent callers are paced one after another
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    def update(self, headers: httpx.Headers) -> None:
+        # edge errors and some redirects come without the headers, the last known quota is kept then
+        remaining = headers.get("x-ratelimit-remaining")
+        reset_at = headers.get("x-ratelimit-reset")
+        if remaining is None or reset_at is None:
+            return
+
+        with suppress(ValueError):
+            self.remaining, self.reset_at = int(remaining), float(reset_at)
+
+    async def wait(self, deadline: float | None = None) -> None:
+        async with self.lock:
+            now = time.time()
+            if self.remaining is None or now >= self.reset_at:
+                return
+
+            if self.remaining <= GITHUB_RATE_LIMIT_RESERVE:
+                # waiting for the reset is only worth it when it is close, otherwise the candidate is deferred
+                if self.reset_at - now > GITHUB_RATE_LIMIT_MAX_WAIT:
+                    raise GitHubRateLimitError(self.reset_at)
+                ready_at = self.reset_at
+            elif self.remaining <= GITHUB_RATE_LIMIT_SLOWDOWN:
+                # spread the remaining quota evenly over the rest of the window
+                ready_at = max(now, self.next_slot)
+            else:
+                return
+
+            # a wait past the candidate's deadline would only turn into timed out README and commit entries
+            if deadline is not None and asyncio.get_running_loop().time() + ready_at - now > deadline:
+                raise GitHubRateLimitError(self.reset_at)
+
+            if self.remaining > GITHUB_RATE_LIMIT_RESERVE:
+                self.next_slot = ready_at + (self.reset_at - now) / self.remaining
+
+        await asyncio.sleep(ready_at - now)
+
+
+GITHUB_RATE_LIMIT = GitHubRateLimit()
+
+
+def cached_response(entry: GitHubResponse) -> httpx.Response:
+    headers = {"etag": entry.etag or "", "link": entry.link or ""}
+    return httpx.Response(OK, headers=headers, content=entry.body.encode())
+
+
+async def github_get(
+    url: str,
+    headers: dict[str, str],
+    params: dict[str, Any] | None = None,
+    deadline: float | None = None,
+) -> httpx.Response:
+    cache_url = str(httpx.URL(url).copy_merge_params(params or {}))
+
+    async with DB_CONFIG.get_session() as db_session:
+        entry = await db_session.scalar(select(GitHubResponse).where(GitHubResponse.url == cache_url))
+        if entry is not None:
+            db_session.expunge(entry)
+
+    if entry is not None and entry.updated_at > datetime.now(UTC) - timedelta(seconds=GITHUB_CACHE_TTL):
+        record_cache("github", hit=True)
+        return cached_response(entry)
+
+    if entry is not None and entry.etag:
+        # 304 replies to conditional requests do not count against the quota
+        headers = {**headers, "If-None-Match": entry.etag}
+
+    await GITHUB_RATE_LIMIT.wait(deadline)
+
+    async with GITHUB_SEMAPHORE:
+        with timed("github.request"):
+            response = await get_github_client().get(cache_url, headers=headers)
+
+    GITHUB_RATE_LIMIT.update(response.headers)
+
+    if response.status_code in {FORBIDDEN, TOO_MANY_REQUESTS} and response.headers.get("x-ratelimit-remaining") == "0":
+        raise GitHubRateLimitError(GITHUB_RATE_LIMIT.reset_at)
+
+    # a 304 is a revalidated hit, it still costs the round trip but not the quota
+    record_cache("github", hit=response.status_code == NOT_MODIFIED and entry is not None)
+
+    if response.status_code == NOT_MODIFIED and entry is not None:
+        async with DB_CONFIG.get_session() as db_session:
+            await db_session.execute(
+                update(GitHubResponse).where(GitHubResponse.id == entry.id).values(updated_at=datetime.now(UTC)),
+            )
+            await db_session.commit()
+        return cached_response(entry)
+
+    if response.status_code == OK:
+        query = insert(GitHubResponse).values(
+            url=cache_url,
+            etag=response.headers.get("etag"),
+            link=response.headers.get("link"),
+            body=response.text,
+        )
+        query = query.on_conflict_do_update(
+            index_elements=[GitHubResponse.url],
+            set_={
+                "etag": query.excluded.etag,
+                "link": query.excluded.link,
+                "body": query.excluded.body,
+                "updated_at": datetime.now(UTC),
+            },
+        )
+        async with DB_CONFIG.get_session() as db_session:
+            await db_session.execute(query)
+            await db_session.commit()
+
+    return response
+
+
+async def evict_github_cache(_: Context) -> None:
+    async with DB_CONFIG.get_session() as db_session:
+        await db_session.execute(
+            delete(GitHubResponse).where(
+                GitHubResponse.updated_at < datetime.now(UTC) - timedelta(seconds=GITHUB_CACHE_MAX_AGE),
+            ),
+        )
+        await db_session.commit()
+
+
+async def run_until[T](deadline: float, coro: Coroutine[Any, Any, T], default: T) -> T:
+    try:
+        async with asyncio.timeout_at(deadline):
+            return await coro
+    except TimeoutError:
+        return default
+
+
+@timed_stage("github.get_user_repos")
 async def get_user_repos(username: str, token=None) -> Any | None:
     url = f"{BASE_URL}/users/{username}/repos?sort=created&direction=desc&per_page=10"
 
@@ -17,35 +208,51 @@ async def get_user_repos(username: str, token=None) -> Any | None:
     if token:
         headers["Authorization"] = f"token {token}"
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers)
+    response = await github_get(url, headers)
 
-        if response.status_code == 200:
-            return response.json()
+    if response.status_code == OK:
+        return response.json()
 
 
-async def get_readme(owner: str, repo: str, token: str | None = None) -> tuple[Any, None] | tuple[None, str]:
+@timed_stage("github.get_readme")
+async def get_readme(
+    owner: str,
+    repo: str,
+    token: str | None = None,
+    deadline: float | None = None,
+) -> tuple[Any, None] | tuple[None, str]:
     url = f"{BASE_URL}/repos/{owner}/{repo}/readme"
     headers = {"Authorization": f"token {token}"} if token else {}
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers)
-        if response.status_code == 200:
-            return response.json(), None
-        error = f"  Failed to fetch README for {owner}/{repo}. Status: {response.status_code}"
-        return None, error
+    response = await github_get(url, headers, deadline=deadline)
+    if response.status_code == OK:
+        return response.json(), None
+    error = f"  Failed to fetch README for {owner}/{repo}. Status: {response.status_code}"
+    return None, error
 
 
-async def generate_repo_info(repos, token: str | None = None) -> str:
+@timed_stage("github.generate_repo_info")
+async def generate_repo_info(repos, token: str | None = None, deadline: float | None = None) -> str:
     repo_info = ""
     if repos:
-        for repo in repos:
+        deadline = deadline or asyncio.get_running_loop().time() + GITHUB_DEADLINE
+        readmes = await asyncio.gather(
+            *(
+                run_until(
+                    deadline,
+                    get_readme(repo["owner"]["login"], repo["name"], token, deadline),
+                    (None, f"  Timed out fetching README for {repo['owner']['login']}/{repo['name']}"),
+                )
+                for repo in repos
+            ),
+        )
+
+        for repo, (readme, error) in zip(repos, readmes, strict=True):
             repo_info += f"\nProject Name: {repo['name']}\n"
             repo_info += f"Main Programming Language: {repo['language']}\n"
             repo_info += f"Description: {repo['description']}\n"
 
             # README
-            readme, error = await get_readme(repo["owner"]["login"], repo["name"], token)
             if readme:
                 try:
                     content = base64.b64decode(readme["content"]).decode("utf-8")
@@ -62,35 +269,41 @@ async def generate_repo_info(repos, token: str | None = None) -> str:
     return repo_info
 
 
-async def get_commit_count_for_repo(owner, repo, username, since_date, token=None) -> tuple[int, str | None]:
+@timed_stage("github.get_commit_count_for_repo")
+async def get_commit_count_for_repo(  # noqa: PLR0913
+    owner,
+    repo,
+    username,
+    since_date,
+    token=None,
+    *,
+    deadline: float | None = None,
+) -> tuple[int, str | None]:
+    key = (owner, repo, username, since_date.date())
+    if key in COMMIT_COUNT_CACHE:
+        return COMMIT_COUNT_CACHE[key], None
+
     url = f"{BASE_URL}/repos/{owner}/{repo}/commits"
     headers = {"Authorization": f"token {token}"} if token else {}
     params = {
         "author": username,
         "since": since_date.isoformat(),
-        "per_page": 100,
+        "per_page": 1,
     }
-    total = 0
-    error = None
-
-    async with httpx.AsyncClient() as client:
-        while url:
-            response = await client.get(url, headers=headers, params=params)
-            if response.status_code == 200:
-                commits = response.json()
-                total += len(commits)
-                # Extract next page URL from Link header if it exists
-                next_link = response.headers.get("link")
-                if next_link and 'rel="next"' in next_link:
-                    # Extract URL between < and >
-                    url = next_link.split("<")[1].split(">")[0]
-                else:
-                    url = None
-                params = {}
-            else:
-                error = f"  Error fetching commits for {owner}/{repo}: {response.status_code}"
-                break
-        return total, error
+
+    response = await github_get(url, headers, params, deadline)
+    if response.status_code != OK:
+        return 0, f"  Error fetching commits for {owner}/{repo}: {response.status_code}"
+
+    # with one commit per page the page number of the last page is the commit count
+    last_url = response.links.get("last", {}).get("url")
+    total = int(httpx.URL(last_url).params["page"]) if last_url else len(response.json())
+
+    if len(COMMIT_COUNT_CACHE) >= COMMIT_COUNT_CACHE_SIZE:
+        COMMIT_COUNT_CACHE.pop(next(iter(COMMIT_COUNT_CACHE)))
+    COMMIT_COUNT_CACHE[key] = total
+
+    return total, None
 
 
 async def process_github(username: str) -> str:
@@ -99,18 +312,39 @@ async def process_github(username: str) -> str:
     repos = await get_user_repos(username, GITHUB_TOKEN)
 
     if repos:
-        repo_info = await generate_repo_info(repos, GITHUB_TOKEN)
+        # README and commit requests for every repo share one deadline per candidate
+        deadline = asyncio.get_running_loop().time() + GITHUB_DEADLINE
+        # truncated to the day so the commit requests keep the same cache key through the day
+        since_date = (datetime.now() - timedelta(days=365)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+        repo_info, counts = await asyncio.gather(
+            generate_repo_info(repos, GITHUB_TOKEN, deadline),
+            asyncio.gather(
+                *(
+                    run_until(
+                        deadline,
+                        get_commit_count_for_repo(
+                            repo["owner"]["login"],
+                            repo["name"],
+                            username,
+                            since_date,
+                            GITHUB_TOKEN,
+                            deadline=deadline,
+                        ),
+                        (0, f"  Timed out fetching commits for {repo['owner']['login']}/{repo['name']}"),
+                    )
+                    for repo in repos
+                ),
+            ),
+        )
         output += repo_info
 
-        since_date = datetime.now() - timedelta(days=365)
         total_commits = 0
 
         output += "\nCalculating commit history...\n"
-        for repo in repos:
-            owner = repo["owner"]["login"]
+        for repo, (count, commit_error) in zip(repos, counts, strict=True):
             repo_name = repo["name"]
             checking_msg = f"  Checking {repo_name}... "
-            count, commit_error = await get_commit_count_for_repo(owner, repo_name, username, since_date, GITHUB_TOKEN)
             total_commits += count
             if commit_error:
                 checking_msg += commit_error
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from collections import deque
+from datetime import UTC, datetime
+from typing import Any, NamedTuple
+
+from saq.types import Context
+from sqlalchemy import ColumnElement, Select, func, insert, select
+
+from config import DB_CONFIG, LLM_LEDGER_BATCH_SIZE, LLM_LEDGER_FLUSH_INTERVAL, LLM_LEDGER_MAX_PENDING
+from models import GenAIModel, LLMCall, LLMCallOutcome, LLMPurpose, LLMUsageGroup
+
+logger = logging.getLogger(__name__)
+
+
+class LLMCallContext(NamedTuple):
+    purpose: LLMPurpose
+    job_id: int | None = None
+    agent_id: int | None = None
+    candidate_id: int | None = None
+
+
+class LLMLedger:
+    # calls are buffered in memory and inserted in batches by a background task, never on the request path
+    def __init__(self, batch_size: int, flush_interval: float, max_pending: int) -> None:  # noqa: D107
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending: deque[dict[str, Any]] = deque(maxlen=max_pending)
+        self.dropped = 0
+        self.task: asyncio.Task[None] | None = None
+
+    def record(  # noqa: PLR0913
+        self,
+        call: LLMCallContext,
+        *,
+        requested_model: GenAIModel,
+        genai_model: GenAIModel,
+        outcome: LLMCallOutcome,
+        input_tokens: int,
+        output_tokens: int,
+        latency: float,
+        retries: int,
+    ) -> None:
+        # a full buffer means the database is down or too slow, the oldest calls make room
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+
+        self.pending.append(
+            {
+                "genai_model": genai_model,
+                "requested_model": requested_model,
+                "purpose": call.purpose,
+                "outcome": outcome,
+                "job_id": call.job_id,
+                "agent_id": call.agent_id,
+                "candidate_id": call.candidate_id,
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "latency_ms": latency * 1000,
+                "retries": retries,
+                "created_at": datetime.now(UTC),
+            },
+        )
+
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    async def run(self) -> None:
+        failed = False
+        while self.pending:
+            # a failed flush waits a full interval too, so a database outage is retried and logged once per interval
+            if failed or len(self.pending) < self.batch_size:
+                await asyncio.sleep(self.flush_interval)
+            failed = not await self.flush()
+
+    async def flush(self) -> bool:
+        while self.pending:
+            batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+            try:
+                async with DB_CONFIG.get_session() as db_session:
+                    await db_session.execute(insert(LLMCall), batch)
+                    await db_session.commit()
+            except Exception:
+                # put back in front and retried on the next flush
+                logger.exception("Failed to write %s LLM calls to the ledger", len(batch))
+                self.pending.extendleft(reversed(batch))
+                return False
+
+        if self.dropped:
+            logger.warning("Dropped %s LLM calls from the ledger, the buffer was full", self.dropped)
+            self.dropped = 0
+
+        return True
+
+
+LLM_LEDGER = LLMLedger(LLM_LEDGER_BATCH_SIZE, LLM_LEDGER_FLUSH_INTERVAL, LLM_LEDGER_MAX_PENDING)
+
+
+async def flush_llm_ledger(_: Context) -> None:
+    await LLM_LEDGER.flush()
+
+
+def usage_group_column(group_by: LLMUsageGroup) -> ColumnElement[Any]:
+    if group_by == LLMUsageGroup.JOB:
+        return LLMCall.job_id
+    if group_by == LLMUsageGroup.AGENT:
+        return LLMCall.agent_id
+    if group_by == LLMUsageGroup.MODEL:
+        return LLMCall.genai_model
+    # days are cut in UTC whatever the session time zone is
+    return func.date(func.timezone("UTC", LLMCall.created_at))
+
+
+def build_usage_query(group_by: LLMUsageGroup, *, by_purpose: bool) -> Select[Any]:
+    key = usage_group_column(group_by).label("key")
+    group = [key, LLMCall.purpose] if by_purpose else [key]
+
+    return (
+        select(
+            *group,
+            func.count(LLMCall.id).label("calls"),
+            func.sum(LLMCall.input_tokens).label("input_tokens"),
+            func.sum(LLMCall.output_tokens).label("output_tokens"),
+            func.sum(LLMCall.latency_ms).label("total_latency_ms"),
+            func.avg(LLMCall.latency_ms).label("avg_latency_ms"),
+            func.percentile_cont(0.95).within_group(LLMCall.latency_ms).label("p95_latency_ms"),
+            func.sum(LLMCall.retries).label("retries"),
+            func.count(LLMCall.id).filter(LLMCall.outcome == LLMCallOutcome.FAILOVER).label("failovers"),
+            func.count(LLMCall.id).filter(LLMCall.outcome == LLMCallOutcome.ERROR).label("errors"),
+        )
+        .group_by(*group)
+        .order_by(*group)
+    )
@@ -0,0 +1,556 @@
+import asyncio
+import hashlib
+import logging
+import random
+import re
+import time
+from collections import defaultdict, deque
+from collections.abc import Awaitable, Callable
+from datetime import timedelta
+from enum import StrEnum
+from functools import lru_cache
+from typing import NamedTuple, Protocol
+
+import cohere
+import httpx
+import msgspec
+from google.generativeai import caching
+from saq.types import Context
+
+from config import (
+    COHERE,
+    GEMINI_CONTEXT_CACHE_MAX_ENTRIES,
+    GEMINI_CONTEXT_CACHE_MIN_TOKENS,
+    GEMINI_CONTEXT_CACHE_TTL,
+    GENERATION_CONFIG,
+    GOOGLE_GENAI,
+    JSON_GENERATION_CONFIG,
+    LLM_FAILOVER_MODELS,
+    LLM_HEDGE_PERCENTILE,
+    LLM_MAX_RETRIES,
+    LLM_PROVIDER,
+    LLM_REQUESTS_PER_MINUTE,
+    LLM_RETRY_BASE_DELAY,
+    LLM_RETRY_MAX_DELAY,
+    LLM_TOKENS_PER_MINUTE,
+    PROFILE_GENERATION_CONFIG,
+)
+from models import GenAIModel, LLMCallOutcome
+from utils.ledger import LLM_LEDGER, LLMCallContext
+from utils.metrics import LLM_REQUEST_DURATION, LLM_TOKENS, record_cache
+from utils.prompt import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+TOO_MANY_REQUESTS = 429
+SERVER_ERROR = 500
+HEDGE_MIN_SAMPLES = 20
+
+
+class LLMOutput(StrEnum):
+    TEXT = "text"
+    SCORE = "score"
+    SCORES = "scores"
+    PROFILE = "profile"
+
+
+GENERATION_CONFIGS = {
+    LLMOutput.TEXT: GENERATION_CONFIG,
+    LLMOutput.SCORE: GENERATION_CONFIG,
+    LLMOutput.SCORES: JSON_GENERATION_CONFIG,
+    LLMOutput.PROFILE: PROFILE_GENERATION_CONFIG,
+}
+
+
+class LLMReply(NamedTuple):
+    text: str | None
+    input_tokens: int
+    output_tokens: int
+    # the model that actually answered, which differs from the requested one after a failover
+    genai_model: GenAIModel | None = None
+
+
+class LLM(Protocol):
+    async def generate(
+        self,
+        genai_model: GenAIModel,
+        system_instruction: str,
+        content: str,
+        output: LLMOutput = LLMOutput.TEXT,
+    ) -> LLMReply: ...
+
+
+@lru_cache(maxsize=256)
+def get_gemini_model(model_name: str, system_instruction: str, output: LLMOutput) -> GOOGLE_GENAI.GenerativeModel:
+    # model objects are built once per system instruction instead of once per candidate
+    return GOOGLE_GENAI.GenerativeModel(  # type: ignore
+        model_name=model_name,
+        generation_config=GENERATION_CONFIGS[output],
+        system_instruction=system_instruction,
+    )
+
+
+class ContextCacheEntry:
+    def __init__(self, content: caching.CachedContent | None, expires_at: float) -> None:  # noqa: D107
+        self.content = content
+        self.expires_at = expires_at
+        self.models: dict[LLMOutput, GOOGLE_GENAI.GenerativeModel] = {}
+
+
+class GeminiContextCache:
+    # system instructions long enough for explicit caching are uploaded once and referenced by every request
+    def __init__(self, ttl: int, min_tokens: int, max_entries: int) -> None:  # noqa: D107
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.max_entries = max_entries
+        self.entries: dict[tuple[str, str], ContextCacheEntry] = {}
+        self.lock = asyncio.Lock()
+
+    async def get_model(
+        self,
+        model_name: str,
+        system_instruction: str,
+        output: LLMOutput,
+    ) -> GOOGLE_GENAI.GenerativeModel | None:
+        if estimate_tokens(system_instruction) < self.min_tokens:
+            return None
+
+        key = (model_name, hashlib.sha256(system_instruction.encode()).hexdigest())
+
+        async with self.lock:
+            entry = self.entries.pop(key, None)
+            now = time.time()
+
+            if entry is not None and entry.content is not None and entry.expires_at - now < self.ttl / 4:
+                # extended before it expires so requests in flight never reference a deleted cache
+                try:
+                    await asyncio.to_thread(entry.content.update, ttl=timedelta(seconds=self.ttl))
+                    entry.expires_at = now + self.ttl
+                except Exception:
+                    logger.warning("Failed to extend context cache %s", entry.content.name, exc_info=True)
+                    entry = None
+
+            hit = entry is not None and entry.content is not None and entry.expires_at > now
+            if entry is None or entry.expires_at <= now:
+                entry = await self.create(model_name, system_instruction)
+
+            self.entries[key] = entry
+            await self.evict()
+
+        record_cache("gemini_context", hit=hit)
+
+        if entry.content is None:
+            return None
+
+        if output not in entry.models:
+            entry.models[output] = GOOGLE_GENAI.GenerativeModel.from_cached_content(  # type: ignore
+                entry.content,
+                generation_config=GENERATION_CONFIGS[output],
+            )
+        return entry.models[output]
+
+    async def create(self, model_name: str, system_instruction: str) -> ContextCacheEntry:
+        try:
+            content = await asyncio.to_thread(
+                caching.CachedContent.create,
+                model=model_name,
+                system_instruction=system_instruction,
+                ttl=timedelta(seconds=self.ttl),
+            )
+        except Exception:
+            # models without caching support keep a negative entry so they are not retried on every request
+            logger.warning("Context caching unavailable for %s", model_name, exc_info=True)
+            return ContextCacheEntry(None, time.time() + self.ttl)
+
+        return ContextCacheEntry(content, time.time() + self.ttl)
+
+    async def evict(self) -> None:
+        while len(self.entries) > self.max_entries:
+            entry = self.entries.pop(next(iter(self.entries)))
+            await self.delete(entry)
+
+    async def delete(self, entry: ContextCacheEntry) -> None:
+        if entry.content is not None:
+            try:
+                await asyncio.to_thread(entry.content.delete)
+            except Exception:
+                logger.warning("Failed to delete context cache %s", entry.content.name, exc_info=True)
+
+    async def clear(self) -> None:
+        async with self.lock:
+            while self.entries:
+                await self.delete(self.entries.popitem()[1])
+
+
+GEMINI_CONTEXT_CACHE = GeminiContextCache(
+    GEMINI_CONTEXT_CACHE_TTL,
+    GEMINI_CONTEXT_CACHE_MIN_TOKENS,
+    GEMINI_CONTEXT_CACHE_MAX_ENTRIES,
+)
+
+
+async def clear_context_cache(_: Context) -> None:
+    await GEMINI_CONTEXT_CACHE.clear()
+
+
+class LiveLLM:
+    async def generate(
+        self,
+        genai_model: GenAIModel,
+        system_instruction: str,
+        content: str,
+        output: LLMOutput = LLMOutput.TEXT,
+    ) -> LLMReply:
+        if genai_model == GenAIModel.COMMAND_R_PLUS:
+            return await self.generate_cohere(genai_model, system_instruction, content, output)
+        return await self.generate_gemini(genai_model, system_instruction, content, output)
+
+    async def generate_cohere(
+        self,
+        genai_model: GenAIModel,
+        system_instruction: str,
+        content: str,
+        output: LLMOutput,
+    ) -> LLMReply:
+        json_output = output in {LLMOutput.SCORES, LLMOutput.PROFILE}
+        response = await COHERE.chat(
+            model=genai_model,
+            messages=[
+                cohere.SystemChatMessageV2(content=system_instruction),
+                cohere.UserChatMessageV2(content=content),
+            ],
+            response_format=cohere.JsonObjectResponseFormatV2() if json_output else cohere.TextResponseFormatV2(),
+        )
+
+        text = None
+        if response.message.content:
+            text = response.message.content[0].text
+
+        tokens = response.usage.tokens if response.usage else None
+        return LLMReply(
+            text,
+            int(tokens.input_tokens or 0) if tokens else 0,
+            int(tokens.output_tokens or 0) if tokens else 0,
+        )
+
+    async def generate_gemini(
+        self,
+        genai_model: GenAIModel,
+        system_instruction: str,
+        content: str,
+        output: LLMOutput,
+    ) -> LLMReply:
+        model = await GEMINI_CONTEXT_CACHE.get_model(genai_model, system_instruction, output)
+        if model is None:
+            model = get_gemini_model(genai_model, system_instruction, output)
+
+        response = await model.generate_content_async(content)
+
+        text = None
+        if response.candidates and response.candidates[0].content.parts:
+            text = response.text
+
+        return LLMReply(
+            text,
+            response.usage_metadata.prompt_token_count,
+            response.usage_metadata.candidates_token_count,
+        )
+
+
+class FakeLLMError(Exception):
+    def __init__(self, status_code: int) -> None:  # noqa: D107
+        super().__init__(f"Fake provider error {status_code}")
+        self.status_code = status_code
+
+
+class FakeLLM:
+    # deterministic replies without network calls, for tests and benchmarks
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, seed: int = 0) -> None:  # noqa: D107
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)  # noqa: S311
+        self.calls = 0
+
+    async def generate(
+        self,
+        genai_model: GenAIModel,  # noqa: ARG002
+        system_instruction: str,
+        content: str,
+        output: LLMOutput = LLMOutput.TEXT,
+    ) -> LLMReply:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            raise FakeLLMError(self.random.choice([429, 500, 503]))
+
+        if output == LLMOutput.SCORE:
+            text = str(self.score(content))
+        elif output == LLMOutput.SCORES:
+            blocks = re.split(r"\*\*CANDIDATE_ID:\*\* (\d+)\n\n", content)[1:]
+            scores = [{"id": int(blocks[i]), "score": self.score(blocks[i + 1])} for i in range(0, len(blocks), 2)]
+            text = msgspec.json.encode({"scores": scores}).decode()
+        elif output == LLMOutput.PROFILE:
+            words = sorted(set(re.findall(r"[A-Z][A-Za-z+#]{2,}", content)))
+            text = msgspec.json.encode({"skills": words[:10], "summary": content[:200]}).decode()
+        else:
+            text = content
+
+        return LLMReply(text, estimate_tokens(system_instruction) + estimate_tokens(content), estimate_tokens(text))
+
+    @staticmethod
+    def score(content: str) -> int:
+        return int.from_bytes(hashlib.sha256(content.encode()).digest()[:4]) % 101
+
+
+def get_provider(genai_model: GenAIModel) -> str:
+    return "cohere" if genai_model == GenAIModel.COMMAND_R_PLUS else "gemini"
+
+
+def is_retryable(exc: BaseException) -> bool:
+    # google exceptions carry the HTTP status as code, cohere and the fake provider as status_code
+    status = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+    if isinstance(status, int):
+        return status == TOO_MANY_REQUESTS or status >= SERVER_ERROR
+    return isinstance(exc, TimeoutError | httpx.TransportError)
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int) -> None:  # noqa: D107
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = float(per_minute)
+        self.updated_at = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, amount: int) -> None:
+        if not self.capacity:
+            return
+
+        # a request larger than the whole bucket waits for a full bucket instead of forever
+        amount = min(amount, self.capacity)
+        self.refill()
+        while self.tokens < amount:
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+            self.refill()
+        self.tokens -= amount
+
+    def consume(self, amount: int) -> None:
+        # output tokens are only known afterwards, they are charged against the next requests
+        if self.capacity:
+            self.refill()
+            self.tokens -= amount
+
+
+class LatencyTracker:
+    def __init__(self, size: int = 200) -> None:  # noqa: D107
+        self.samples: deque[float] = deque(maxlen=size)
+
+    def add(self, latency: float) -> None:
+        self.samples.append(latency)
+
+    def percentile(self, percentile: float) -> float | None:
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+class CallAttempts:
+    def __init__(self) -> None:  # noqa: D107
+        self.retries = 0
+
+
+class LLMGateway:
+    # every model call goes through here for rate limiting, retries, hedging and failover
+    def __init__(self) -> None:  # noqa: D107
+        self.request_buckets = {provider: TokenBucket(limit) for provider, limit in LLM_REQUESTS_PER_MINUTE.items()}
+        self.token_buckets = {provider: TokenBucket(limit) for provider, limit in LLM_TOKENS_PER_MINUTE.items()}
+        self.latencies: dict[GenAIModel, LatencyTracker] = defaultdict(LatencyTracker)
+
+    async def attempt(
+        self,
+        genai_model: GenAIModel,
+        system_instruction: str,
+        content: str,
+        output: LLMOutput,
+    ) -> LLMReply:
+        provider = get_provider(genai_model)
+        await self.request_buckets[provider].acquire(1)
+        await self.token_buckets[provider].acquire(estimate_tokens(system_instruction) + estimate_tokens(content))
+
+        started = time.monotonic()
+        try:
+            reply = await get_llm().generate(genai_model, system_instruction, content, output)
+        except Exception:
+            LLM_REQUEST_DURATION.observe(time.monotonic() - started, genai_model, "error")
+            raise
+
+        latency = time.monotonic() - started
+        self.latencies[genai_model].add(latency)
+        self.token_buckets[provider].consume(reply.output_tokens)
+
+        LLM_REQUEST_DURATION.observe(latency, genai_model, "success")
+        LLM_TOKENS.inc(genai_model, "input", amount=reply.input_tokens)
+        LLM_TOKENS.inc(genai_model, "output", amount=reply.output_tokens)
+
+        return reply
+
+    async def hedged_attempt(
+        self,
+        genai_model: GenAIModel,
+        system_instruction: str,
+        content: str,
+        output: LLMOutput,
+    ) -> LLMReply:
+        delay = self.latencies[genai_model].percentile(LLM_HEDGE_PERCENTILE) if LLM_HEDGE_PERCENTILE else None
+        if delay is None:
+            return await self.attempt(genai_model, system_instruction, content, output)
+
+        # a second request is only sent when the first one is slower than the percentile, the first reply wins
+        tasks = [asyncio.create_task(self.attempt(genai_model, system_instruction, content, output))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                tasks.append(asyncio.create_task(self.attempt(genai_model, system_instruction, content, output)))
+
+            error: BaseException | None = None
+            for task in asyncio.as_completed(tasks):
+                try:
+                    return await task
+                except Exception as e:  # noqa: BLE001
+                    error = e
+            raise error  # type: ignore[misc]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    async def with_retries[T](model: str, request: Callable[[], Awaitable[T]], attempts: CallAttempts) -> T:
+        retry = 0
+        while True:
+            try:
+                return await request()
+            except Exception as e:
+                if retry == LLM_MAX_RETRIES or not is_retryable(e):
+                    raise
+                # full jitter keeps workers that failed together from retrying together
+                delay = random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2**retry))  # noqa: S311
+                logger.warning("Retrying %s in %.2fs after %r", model, delay, e)
+                await asyncio.sleep(delay)
+                retry += 1
+                attempts.retries += 1
+
+    async def generate_with_retries(
+        self,
+        genai_model: GenAIModel,
+        system_instruction: str,
+        content: str,
+        output: LLMOutput,
+        attempts: CallAttempts,
+    ) -> LLMReply:
+        return await self.with_retries(
+            genai_model,
+            lambda: self.hedged_attempt(genai_model, system_instruction, content, output),
+            attempts,
+        )
+
+    async def embed(self, model: str, texts: list[str], input_type: str) -> list[list[float]]:
+        # embed requests share the cohere buckets with the chat calls, they are retried but never failed over
+        async def attempt() -> list[list[float]]:
+            await self.request_buckets["cohere"].acquire(1)
+            await self.token_buckets["cohere"].acquire(sum(estimate_tokens(text) for text in texts))
+
+            started = time.monotonic()
+            try:
+                response = await COHERE.embed(
+                    model=model,
+                    input_type=input_type,
+                    embedding_types=["float"],
+                    texts=texts,
+                    truncate="END",
+                )
+            except Exception:
+                LLM_REQUEST_DURATION.observe(time.monotonic() - started, model, "error")
+                raise
+
+            LLM_REQUEST_DURATION.observe(time.monotonic() - started, model, "success")
+            return response.embeddings.float_ or []
+
+        return await self.with_retries(model, attempt, CallAttempts())
+
+    async def generate(  # noqa: PLR0913
+        self,
+        genai_model: GenAIModel,
+        system_instruction: str,
+        content: str,
+        output: LLMOutput = LLMOutput.TEXT,
+        *,
+        failover: bool = True,
+        call: LLMCallContext | None = None,
+    ) -> LLMReply:
+        started = time.monotonic()
+        attempts = CallAttempts()
+        answered_by = genai_model
+        outcome = LLMCallOutcome.ERROR
+        reply = None
+
+        try:
+            try:
+                reply = await self.generate_with_retries(genai_model, system_instruction, content, output, attempts)
+                outcome = LLMCallOutcome.SUCCESS
+            except Exception as e:
+                failover_model = LLM_FAILOVER_MODELS.get(get_provider(genai_model))
+                if not failover or not failover_model or not is_retryable(e):
+                    raise
+
+                logger.warning("Failing over from %s to %s after %r", genai_model, failover_model, e)
+                answered_by = GenAIModel(failover_model)
+                reply = await self.generate_with_retries(answered_by, system_instruction, content, output, attempts)
+                outcome = LLMCallOutcome.FAILOVER
+
+            return reply._replace(genai_model=answered_by)
+        finally:
+            # failed and cancelled calls are recorded too, they cost wall time and sometimes tokens
+            if call is not None:
+                LLM_LEDGER.record(
+                    call,
+                    requested_model=genai_model,
+                    genai_model=answered_by,
+                    outcome=outcome,
+                    input_tokens=reply.input_tokens if reply is not None else 0,
+                    output_tokens=reply.output_tokens if reply is not None else 0,
+                    latency=time.monotonic() - started,
+                    retries=attempts.retries,
+                )
+
+
+LLM_GATEWAY = LLMGateway()
+
+LLM_INSTANCE: LLM = FakeLLM() if LLM_PROVIDER == "fake" else LiveLLM()
+
+
+def get_llm() -> LLM:
+    return LLM_INSTANCE
+
+
+def set_llm(llm: LLM) -> None:
+    global LLM_INSTANCE  # noqa: PLW0603
+    LLM_INSTANCE = llm
+
+
+async def generate(  # noqa: PLR0913
+    genai_model: GenAIModel,
+    system_instruction: str,
+    content: str,
+    output: LLMOutput = LLMOutput.TEXT,
+    *,
+    failover: bool = True,
+    call: LLMCallContext | None = None,
+) -> LLMReply:
+    return await LLM_GATEWAY.generate(genai_model, system_instruction, content, output, failover=failover, call=call)
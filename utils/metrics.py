@@ -0,0 +1,309 @@
+import asyncio
+import bisect
+import fcntl
+import json
+import logging
+import os
+import secrets
+import time
+from collections.abc import Awaitable, Callable, Iterator
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from functools import wraps
+from pathlib import Path
+from typing import Any
+
+from saq.types import Context
+
+from config import METRICS_DIR, METRICS_ENABLED, METRICS_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+NO_TIMER = nullcontext()
+
+# counters of exited processes are folded into this file so the directory does not grow with every restart
+EXITED_FILE = "exited.json"
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def file_process_exited(path: Path) -> bool:
+    # snapshot files are named after the pid of the process writing them
+    pid = path.stem.split("-")[0]
+    return pid.isdigit() and not process_exists(int(pid))
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values, strict=True)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...]) -> None:  # noqa: D107
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        if not METRICS_ENABLED:
+            return
+        self.values[labels] = self.values.get(labels, 0) + amount
+        REGISTRY.changed()
+
+    def snapshot(self) -> list[Any]:
+        return [[list(labels), value] for labels, value in self.values.items()]
+
+    @staticmethod
+    def merge(total: dict[tuple[str, ...], Any], snapshot: list[Any]) -> None:
+        for labels, value in snapshot:
+            key = tuple(labels)
+            total[key] = total.get(key, 0) + value
+
+    def render(self, values: dict[tuple[str, ...], Any]) -> Iterator[str]:
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(  # noqa: D107
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...],
+        buckets: tuple[float, ...] = DURATION_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # per label set: one count per bucket plus +Inf, then the sum
+        self.values: dict[tuple[str, ...], list[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        if not METRICS_ENABLED:
+            return
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+        REGISTRY.changed()
+
+    def snapshot(self) -> list[Any]:
+        return [[list(labels), counts] for labels, counts in self.values.items()]
+
+    @staticmethod
+    def merge(total: dict[tuple[str, ...], Any], snapshot: list[Any]) -> None:
+        for labels, counts in snapshot:
+            key = tuple(labels)
+            if key in total:
+                total[key] = [a + b for a, b in zip(total[key], counts, strict=True)]
+            else:
+                total[key] = list(counts)
+
+    def render(self, values: dict[tuple[str, ...], Any]) -> Iterator[str]:
+        for labels, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip([*map(str, self.buckets), "+Inf"], counts, strict=False):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(self.labelnames, labels, f'le="{bound}"')} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, labels)} {counts[-1]}"
+            yield f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class MetricsRegistry:
+    # the api and every SAQ worker process write their own snapshot file, /metrics adds them up
+    def __init__(self, directory: Path, flush_interval: float) -> None:  # noqa: D107
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metrics: dict[str, Counter | Histogram] = {}
+        self.flush_scheduled = False
+        self.token = secrets.token_hex(4)
+
+    def register[M: Counter | Histogram](self, metric: M) -> M:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def reset(self) -> None:
+        # a forked worker starts from zero under its own file instead of repeating the parent's counters
+        for metric in self.metrics.values():
+            metric.values.clear()
+        self.flush_scheduled = False
+        self.token = secrets.token_hex(4)
+
+    @property
+    def path(self) -> Path:
+        # the token keeps a process that reuses the pid of an exited one from overwriting its counters
+        return self.directory / f"{os.getpid()}-{self.token}.json"
+
+    def snapshot(self) -> dict[str, list[Any]]:
+        return {name: metric.snapshot() for name, metric in self.metrics.items() if metric.values}
+
+    def changed(self) -> None:
+        # at most one write per interval, scheduled on the first change after the previous write
+        if self.flush_scheduled:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.flush_scheduled = True
+        loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self) -> None:
+        self.flush_scheduled = False
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            temporary = self.path.with_suffix(".tmp")
+            temporary.write_text(json.dumps(self.snapshot()))
+            temporary.replace(self.path)
+        except OSError:
+            logger.warning("Failed to write metrics to %s", self.directory, exc_info=True)
+
+    def merge(self, snapshots: list[dict[str, list[Any]]]) -> dict[str, dict[tuple[str, ...], Any]]:
+        totals: dict[str, dict[tuple[str, ...], Any]] = {name: {} for name in self.metrics}
+        for snapshot in snapshots:
+            for name, values in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is not None:
+                    metric.merge(totals[name], values)
+        return totals
+
+    @staticmethod
+    def to_snapshot(totals: dict[str, dict[tuple[str, ...], Any]]) -> dict[str, list[Any]]:
+        return {name: [[list(labels), value] for labels, value in values.items()] for name, values in totals.items()}
+
+    @staticmethod
+    def read(path: Path) -> dict[str, list[Any]] | None:
+        try:
+            return json.loads(path.read_text())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logger.warning("Skipping unreadable metrics file %s", path)
+            return None
+
+    def fold_exited(self) -> None:
+        # the files of exited processes are added to EXITED_FILE and removed, so their counters never go backwards
+        exited = self.directory / EXITED_FILE
+        snapshots = {path: self.read(path) for path in self.directory.glob("*.json") if file_process_exited(path)}
+        folded = [(path, snapshot) for path, snapshot in snapshots.items() if snapshot is not None]
+
+        if not folded:
+            return
+
+        totals = self.merge([self.read(exited) or {}, *(snapshot for _, snapshot in folded)])
+        temporary = exited.with_suffix(".tmp")
+        temporary.write_text(json.dumps(self.to_snapshot(totals)))
+        temporary.replace(exited)
+        for path, _ in folded:
+            path.unlink(missing_ok=True)
+
+    def collect(self) -> dict[str, dict[tuple[str, ...], Any]]:
+        snapshots = [self.snapshot()]
+
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # several api processes can scrape at once, the lock keeps them from folding the same file twice
+            with (self.directory / ".lock").open("w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self.fold_exited()
+                others = [self.read(path) for path in self.directory.glob("*.json") if path != self.path]
+                snapshots.extend(snapshot for snapshot in others if snapshot is not None)
+        except OSError:
+            logger.warning("Failed to read metrics from %s", self.directory, exc_info=True)
+
+        return self.merge(snapshots)
+
+    def render(self) -> str:
+        lines = []
+        for name, values in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.extend(metric.render(values))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry(Path(METRICS_DIR), METRICS_FLUSH_INTERVAL)
+os.register_at_fork(after_in_child=REGISTRY.reset)
+
+STAGE_DURATION = REGISTRY.register(
+    Histogram("nexus_stage_duration_seconds", "Duration of pipeline stages", ("stage", "outcome")),
+)
+LLM_REQUEST_DURATION = REGISTRY.register(
+    Histogram("nexus_llm_request_duration_seconds", "Duration of single LLM requests", ("model", "outcome")),
+)
+LLM_TOKENS = REGISTRY.register(
+    Counter("nexus_llm_tokens_total", "LLM tokens sent and received", ("model", "direction")),
+)
+CACHE_REQUESTS = REGISTRY.register(
+    Counter("nexus_cache_requests_total", "Cache lookups by cache and result", ("cache", "result")),
+)
+
+
+@contextmanager
+def stage_timer(stage: str) -> Iterator[None]:
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "success"
+    finally:
+        STAGE_DURATION.observe(time.perf_counter() - started, stage, outcome)
+
+
+def timed(stage: str) -> AbstractContextManager[None]:
+    # a shared no-op context when metrics are off, so the hot paths only pay for one check
+    return stage_timer(stage) if METRICS_ENABLED else NO_TIMER
+
+
+def timed_stage[**P, T](stage: str) -> Callable[[Callable[P, Awaitable[T]]], Callable[P, Awaitable[T]]]:
+    def decorator(function: Callable[P, Awaitable[T]]) -> Callable[P, Awaitable[T]]:
+        if not METRICS_ENABLED:
+            return function
+
+        @wraps(function)
+        async def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+            with stage_timer(stage):
+                return await function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_cache(cache: str, *, hit: bool, amount: int = 1) -> None:
+    if amount:
+        CACHE_REQUESTS.inc(cache, "hit" if hit else "miss", amount=amount)
+
+
+def render_metrics() -> str:
+    return REGISTRY.render()
+
+
+async def flush_metrics(_: Context) -> None:
+    if METRICS_ENABLED:
+        REGISTRY.flush()
@@ -0,0 +1,15 @@
+import base64
+
+import msgspec
+
+
+def encode_cursor(*values: object) -> str:
+    return base64.urlsafe_b64encode(msgspec.json.encode(values)).decode().rstrip("=")
+
+
+def decode_cursor[T](cursor: str, type_: type[T]) -> T | None:
+    # cursors are opaque to clients, a tampered or stale one is rejected instead of raising
+    try:
+        return msgspec.json.decode(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)), type=type_)
+    except (ValueError, msgspec.DecodeError):
+        return None
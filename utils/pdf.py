@@ -0,0 +1,11 @@
+import pymupdf
+
+# runs in the resume parsing worker processes, which import this module on their own under the spawn and
+# forkserver start methods, so it only depends on pymupdf and never on config
+
+
+def extract_pages(stream: bytes, start: int, stop: int, max_pages: int) -> tuple[str, int]:
+    with pymupdf.open(stream=stream, filetype="pdf") as document:
+        stop = min(stop, document.page_count, max_pages)
+        text = "".join(document[index].get_text() for index in range(start, stop))  # type: ignore
+        return text, document.page_count
@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+
+from crawl4ai import AsyncWebCrawler, CacheMode, CrawlerRunConfig, CrawlResult
+from crawl4ai.content_filter_strategy import PruningContentFilter
+from crawl4ai.markdown_generation_strategy import DefaultMarkdownGenerator
+from saq.types import Context
+from usp.tree import sitemap_tree_for_homepage
+from usp.web_client.abstract_client import AbstractWebClientResponse
+from usp.web_client.requests_client import RequestsWebClient, RequestsWebClientErrorResponse
+
+from config import (
+    CRAWLER_PAGES_PER_BROWSER,
+    CRAWLER_POOL_SIZE,
+    CRAWLER_RECYCLE_PAGES,
+    PORTFOLIO_CONCURRENCY,
+    PORTFOLIO_DEADLINE,
+    PORTFOLIO_MAX_BYTES,
+    PORTFOLIO_MAX_PAGES,
+    PORTFOLIO_SITEMAP_TIMEOUT,
+)
+from utils.metrics import timed
+from utils.prompt import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# page chrome is dropped and the rest is converted to markdown in the crawler, before any of it reaches the model
+RUN_CONFIG = CrawlerRunConfig(
+    cache_mode=CacheMode.BYPASS,
+    excluded_tags=["script", "style", "noscript", "nav", "header", "footer", "form", "svg", "iframe"],
+    remove_overlay_elements=True,
+    markdown_generator=DefaultMarkdownGenerator(
+        content_filter=PruningContentFilter(),
+        options={"ignore_links": True, "ignore_images": True},
+    ),
+)
+
+
+class PooledCrawler:
+    def __init__(self, pages_per_browser: int) -> None:  # noqa: D107
+        self.crawler = AsyncWebCrawler()
+        self.slots = asyncio.Semaphore(pages_per_browser)
+        self.pages = 0
+        self.active = 0
+        self.retired = False
+
+
+class CrawlerPool:
+    # browsers are started once per worker process, every page crawl opens its own tab in the least busy one
+    def __init__(self, size: int, pages_per_browser: int, recycle_pages: int) -> None:  # noqa: D107
+        self.size = size
+        self.pages_per_browser = pages_per_browser
+        self.recycle_pages = recycle_pages
+        self.crawlers: list[PooledCrawler] = []
+        self.lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        async with self.lock:
+            while len(self.crawlers) < self.size:
+                pooled = PooledCrawler(self.pages_per_browser)
+                await pooled.crawler.start()
+                self.crawlers.append(pooled)
+
+    async def close(self) -> None:
+        async with self.lock:
+            while self.crawlers:
+                await self.crawlers.pop().crawler.close()
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[AsyncWebCrawler]:
+        if len(self.crawlers) < self.size:
+            await self.start()
+
+        pooled = min(self.crawlers, key=lambda pooled: pooled.active)
+        pooled.active += 1
+        pooled.pages += 1
+
+        # a browser only grows while it runs, after recycle_pages pages it leaves the pool, a fresh one is
+        # started by the next acquire and the old one is closed once its last page finishes
+        if pooled.pages >= self.recycle_pages:
+            self.crawlers.remove(pooled)
+            pooled.retired = True
+
+        try:
+            async with pooled.slots:
+                yield pooled.crawler
+        finally:
+            pooled.active -= 1
+            if pooled.retired and pooled.active == 0:
+                await pooled.crawler.close()
+
+
+CRAWLER_POOL = CrawlerPool(CRAWLER_POOL_SIZE, CRAWLER_PAGES_PER_BROWSER, CRAWLER_RECYCLE_PAGES)
+
+
+async def start_crawler_pool(_: Context) -> None:
+    # a browser that fails to launch here is retried on first use instead of failing the worker
+    try:
+        await CRAWLER_POOL.start()
+    except Exception:
+        logger.exception("Failed to start the crawler pool")
+
+
+async def close_crawler_pool(_: Context) -> None:
+    await CRAWLER_POOL.close()
+
+
+class DeadlineWebClient(RequestsWebClient):
+    # a thread cannot be cancelled, the client stops fetching sitemaps by itself once the deadline has passed
+    def __init__(self, deadline: float) -> None:  # noqa: D107
+        super().__init__()
+        self.deadline = deadline
+
+    def get(self, url: str) -> AbstractWebClientResponse:
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            return RequestsWebClientErrorResponse(message="Sitemap discovery deadline exceeded", retryable=False)
+
+        self.set_timeout(remaining)
+        return super().get(url)
+
+
+PRIORITY_KEYWORDS = ("about", "project", "work", "experience", "resume", "cv", "portfolio")
+
+
+def page_priority(homepage: str, page_url: str) -> tuple[int, int]:
+    if page_url.rstrip("/") == homepage.rstrip("/"):
+        return 0, 0
+
+    path = urlparse(page_url).path.lower()
+    if any(keyword in path for keyword in PRIORITY_KEYWORDS):
+        return 1, path.count("/")
+
+    # shallow pages usually summarise the deeper ones
+    return 2, path.count("/")
+
+
+async def discover_portfolio_pages(url: str) -> list[str]:
+    def discover() -> list[str]:
+        web_client = DeadlineWebClient(time.monotonic() + PORTFOLIO_SITEMAP_TIMEOUT)
+        return [page.url for page in sitemap_tree_for_homepage(url, web_client=web_client).all_pages()]
+
+    # usp is synchronous and fetches every sitemap, it runs in a thread so the worker loop keeps going,
+    # the deadline client ends the thread shortly after the timeout instead of leaving it fetching
+    try:
+        with timed("portfolio.sitemap"):
+            async with asyncio.timeout(PORTFOLIO_SITEMAP_TIMEOUT):
+                pages = await asyncio.to_thread(discover)
+    except Exception:
+        logger.warning("Sitemap discovery failed for %s", url, exc_info=True)
+        pages = []
+
+    urls = list(dict.fromkeys([url, *pages]))
+    urls.sort(key=lambda page_url: page_priority(url, page_url))
+
+    return urls[:PORTFOLIO_MAX_PAGES]
+
+
+def page_markdown(result: CrawlResult) -> str:
+    markdown = result.markdown_v2
+    if markdown is None:
+        return result.markdown or ""
+
+    # the pruning filter can empty a page that is mostly short blocks, the unfiltered markdown is kept then
+    return markdown.fit_markdown.strip() or markdown.raw_markdown.strip()
+
+
+def dedupe_blocks(pages: list[str]) -> list[str]:
+    # menus, footers and contact blocks repeat on every page of a site, only their first occurrence is kept
+    seen: set[str] = set()
+    deduped = []
+    for page in pages:
+        lines = []
+        for line in page.splitlines():
+            key = " ".join(line.split()).lower()
+            if not key:
+                if lines and lines[-1]:
+                    lines.append("")
+                continue
+            if key.startswith("#"):
+                lines.append(line)
+                continue
+            if key in seen:
+                continue
+            seen.add(key)
+            lines.append(line)
+        deduped.append("\n".join(lines).strip())
+    return deduped
+
+
+async def process_portfolio(url: str) -> str:
+    urls = await discover_portfolio_pages(url)
+    pages: dict[str, str] = {}
+    total_bytes = 0
+    html_tokens = 0
+    semaphore = asyncio.Semaphore(PORTFOLIO_CONCURRENCY)
+
+    async def crawl(page_url: str) -> None:
+        nonlocal total_bytes, html_tokens
+
+        # the homepage is always kept, the byte budget only limits the pages after it
+        homepage = page_url == urls[0]
+
+        async with semaphore, CRAWLER_POOL.acquire() as crawler:
+            if total_bytes >= PORTFOLIO_MAX_BYTES and not homepage:
+                return
+
+            with timed("portfolio.crawl"):
+                result = await crawler.arun(
+                    url=page_url,
+                    config=RUN_CONFIG,
+                )
+
+        if result.success and (homepage or total_bytes < PORTFOLIO_MAX_BYTES):
+            pages[page_url] = page_markdown(result)
+            total_bytes += len(result.html)
+            html_tokens += estimate_tokens(result.html)
+
+    tasks = [asyncio.create_task(crawl(page_url)) for page_url in urls]
+    _, pending = await asyncio.wait(tasks, timeout=PORTFOLIO_DEADLINE)
+
+    # pages still loading at the deadline are dropped, the ones already crawled are kept
+    if pending:
+        logger.warning("Portfolio %s: %s pages dropped at the %ss deadline", url, len(pending), PORTFOLIO_DEADLINE)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    crawled = [page_url for page_url in urls if page_url in pages]
+    markdown = dedupe_blocks([pages[page_url] for page_url in crawled])
+    output = "\n\n".join(f"URL: {page_url}\n{page}" for page_url, page in zip(crawled, markdown, strict=True) if page)
+
+    logger.info(
+        "Portfolio %s: %s pages reduced from ~%s HTML tokens to ~%s markdown tokens",
+        url,
+        len(crawled),
+        html_tokens,
+        estimate_tokens(output),
+    )
+
+    return output
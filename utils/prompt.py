@@ -0,0 +1,96 @@
+from typing import NamedTuple
+
+from models import GenAIModel
+
+# budgets for the candidate part of a prompt, well below each context window to keep latency and cost bounded
+TOKEN_BUDGETS = {
+    GenAIModel.GEMINI_2_0_FLASH: 32000,
+    GenAIModel.GEMINI_1_5_FLASH: 32000,
+    GenAIModel.GEMINI_1_5_FLASH_8B: 16000,
+    GenAIModel.COMMAND_R_PLUS: 16000,
+}
+
+# higher weights get a larger share of the budget when the sections do not all fit
+SECTION_WEIGHTS = {
+    "RESUME": 4,
+    "LINKEDIN": 2,
+    "GITHUB": 2,
+    "PORTFOLIO": 1,
+}
+
+TRUNCATION_MARKER = "\n[truncated]"
+
+
+class PromptSection(NamedTuple):
+    title: str
+    text: str
+    weight: int
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def allocate_budget(sections: list[PromptSection], budget: int) -> list[int]:
+    needs = [estimate_tokens(section.text) for section in sections]
+    allocation = [0] * len(sections)
+    open_sections = set(range(len(sections)))
+    remaining = budget
+
+    # sections smaller than their weighted share get what they need, the rest is shared again by the larger ones
+    while open_sections:
+        total_weight = sum(sections[i].weight for i in open_sections)
+        shares = {i: remaining * sections[i].weight // total_weight for i in open_sections}
+        fitting = [i for i in open_sections if needs[i] <= shares[i]]
+
+        if not fitting:
+            for i in open_sections:
+                allocation[i] = shares[i]
+            break
+
+        for i in fitting:
+            allocation[i] = needs[i]
+            remaining -= needs[i]
+            open_sections.remove(i)
+
+    return allocation
+
+
+def truncate_text(text: str, tokens: int) -> str:
+    if estimate_tokens(text) <= tokens:
+        return text
+
+    limit = max(tokens * 4 - len(TRUNCATION_MARKER), 0)
+    truncated = text[:limit]
+
+    # cut on a line break when there is one close to the limit so sections do not end mid sentence
+    newline = truncated.rfind("\n")
+    if newline > limit * 0.8:
+        truncated = truncated[:newline]
+
+    return truncated + TRUNCATION_MARKER
+
+
+def build_prompt(sections: list[PromptSection], budget: int) -> str:
+    allocation = allocate_budget(sections, budget)
+    return "\n\n\n\n".join(
+        f"**{section.title}:** {truncate_text(section.text, tokens)}"
+        for section, tokens in zip(sections, allocation, strict=True)
+    )
+
+
+def build_candidate_prompt(
+    genai_model: GenAIModel,
+    *,
+    resume: str | None,
+    linkedin: str | None,
+    github: str | None,
+    portfolio: str | None,
+) -> str:
+    sections = [
+        PromptSection("RESUME", str(resume), SECTION_WEIGHTS["RESUME"]),
+        PromptSection("LINKEDIN", str(linkedin), SECTION_WEIGHTS["LINKEDIN"]),
+        PromptSection("GITHUB", str(github), SECTION_WEIGHTS["GITHUB"]),
+        PromptSection("PORTFOLIO", str(portfolio), SECTION_WEIGHTS["PORTFOLIO"]),
+    ]
+    return build_prompt(sections, TOKEN_BUDGETS[genai_model])
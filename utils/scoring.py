@@ -0,0 +1,574 @@
+import asyncio
+import hashlib
+import logging
+from collections.abc import AsyncIterator
+from contextlib import suppress
+from datetime import UTC, datetime, timedelta
+from typing import Any, NamedTuple
+
+import msgspec
+from saq import Queue
+from saq.types import Context
+from sqlalchemy import ColumnElement, Row, Select, and_, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import (
+    DB_CONFIG,
+    DEFAULT_GENAI_MODEL,
+    PRECOMPUTE_MAX_PASSES,
+    SCORING_BATCH_MAX_SIZE,
+    SCORING_BATCH_TIMEOUT,
+    SCORING_BATCH_TOKEN_BUDGET,
+    SCORING_CHUNK_SIZE,
+    SCORING_CONCURRENCY,
+    SCORING_FAILURE_RETRY_AFTER,
+    SCORING_TIMEOUT,
+)
+from models import Agent, Candidate, FitScore, GenAIModel, Job, JobApplication, LLMPurpose, ScoreStatus
+from schema.job_application import CandidateScores
+from utils.ledger import LLMCallContext
+from utils.llm import LLMOutput, generate, get_provider
+from utils.metrics import record_cache, timed_stage
+from utils.prompt import build_candidate_prompt, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+SCORING_SEMAPHORES = {provider: asyncio.Semaphore(limit) for provider, limit in SCORING_CONCURRENCY.items()}
+
+
+class PendingScore(NamedTuple):
+    row: Row[Any]
+    candidate_data: str
+    input_hash: str
+
+
+def build_ranking_query(job_id: int) -> Select[Any]:
+    return (
+        select(
+            JobApplication.id,
+            Candidate.id.label("candidate_id"),
+            Candidate.candidate_name,
+            Candidate.candidate_email,
+            Candidate.candidate_phone,
+            Candidate.candidate_current_yoe,
+            Candidate.candidate_current_role,
+            Candidate.candidate_resume_id,
+            Candidate.data_processed,
+            Candidate.candidate_image,
+            Candidate.candidate_resume_data,
+            Candidate.candidate_linkedin_data,
+            Candidate.candidate_github_data,
+            Candidate.candidate_portfolio_data,
+            Candidate.updated_at.label("candidate_updated_at"),
+            JobApplication.created_at,
+            JobApplication.candidate_summary,
+            JobApplication.candidate_skills,
+        )
+        .join(Candidate, JobApplication.candidate_id == Candidate.id)
+        .where(JobApplication.job_id == job_id)
+    )
+
+
+def build_ranking_read_query(job_id: int, agent_id: int, genai_model: GenAIModel) -> Select[Any]:
+    # served straight from the fit_score index, the large candidate data columns are never loaded here
+    return (
+        select(
+            JobApplication.id,
+            Candidate.candidate_name,
+            Candidate.candidate_email,
+            Candidate.candidate_phone,
+            Candidate.candidate_current_yoe,
+            Candidate.candidate_current_role,
+            Candidate.candidate_resume_id,
+            Candidate.data_processed,
+            Candidate.candidate_image,
+            Candidate.updated_at.label("candidate_updated_at"),
+            JobApplication.created_at,
+            JobApplication.candidate_summary,
+            JobApplication.candidate_skills,
+            FitScore.score,
+            FitScore.updated_at.label("scored_at"),
+        )
+        .join(Candidate, JobApplication.candidate_id == Candidate.id)
+        .outerjoin(
+            FitScore,
+            and_(
+                # redundant with the application id, but it lets the join use the job_id prefix of ix_fit_score_ranking
+                FitScore.job_id == job_id,
+                FitScore.job_application_id == JobApplication.id,
+                FitScore.agent_id == agent_id,
+                FitScore.genai_model == genai_model,
+            ),
+        )
+        .where(JobApplication.job_id == job_id)
+        .order_by(FitScore.score.desc().nulls_last(), JobApplication.id)
+    )
+
+
+def after_score(score: int | None, application_id: int) -> ColumnElement[bool]:
+    # keyset condition matching the score desc nulls last, id order of build_ranking_read_query
+    if score is None:
+        return and_(FitScore.score.is_(None), JobApplication.id > application_id)
+    return or_(
+        FitScore.score < score,
+        and_(FitScore.score == score, JobApplication.id > application_id),
+        FitScore.score.is_(None),
+    )
+
+
+def filter_ranking_query(
+    query: Select[Any],
+    *,
+    data_processed: bool | None = None,
+    min_score: int | None = None,
+    max_score: int | None = None,
+) -> Select[Any]:
+    if data_processed is not None:
+        query = query.where(Candidate.data_processed == data_processed)
+
+    if min_score is not None:
+        query = query.where(FitScore.score >= min_score)
+
+    if max_score is not None:
+        query = query.where(FitScore.score <= max_score)
+
+    return query
+
+
+async def load_ranking_chunk(db_session: AsyncSession, query: Select[Any], after_id: int) -> list[Row[Any]]:
+    # the candidate data columns are only held for SCORING_CHUNK_SIZE applicants at a time
+    result = await db_session.execute(
+        query.where(JobApplication.id > after_id).order_by(JobApplication.id).limit(SCORING_CHUNK_SIZE),
+    )
+    return list(result)
+
+
+def build_application(row: Row[Any], progress: int | None, score_status: ScoreStatus) -> dict[str, Any]:
+    return {
+        "id": row.id,
+        "candidate_name": row.candidate_name,
+        "candidate_email": row.candidate_email,
+        "candidate_phone": row.candidate_phone,
+        "candidate_current_yoe": row.candidate_current_yoe,
+        "candidate_current_role": row.candidate_current_role,
+        "candidate_resume": row.candidate_resume_id,
+        "applied_date": row.created_at.isoformat(),
+        "data_processed": row.data_processed,
+        "progress": progress,
+        "score_status": score_status,
+        "summary": row.candidate_summary,
+        "avatar": row.candidate_image,
+        "skills": row.candidate_skills or [],
+    }
+
+
+def build_job_context(agent: Agent, job: Job) -> str:
+    return f"SYSTEM: You are a AI agent named {agent.agent_name} helping recruiters to process the candidate applications. Your task is to analyze the provided candidate information and generate how much the candidate is suitable for the job. The higher the number, the more suitable the candidate is for the job.\n\nAGENT_INSTRUCTION: {agent.agent_instructions}\n\nJOB_DESCRIPTION: {job.job_description}\n\nJOB_REQUIREMENTS: {job.job_requirements}"
+
+
+def build_system_instruction(agent: Agent, job: Job) -> str:
+    return f"{build_job_context(agent, job)}\n\nSYSTEM: Keep in mind that you can only reply with a number between 0 to 100 one time"
+
+
+def build_batch_system_instruction(agent: Agent, job: Job) -> str:
+    return f'{build_job_context(agent, job)}\n\nSYSTEM: You will receive several candidates, each one starts with its CANDIDATE_ID. Keep in mind that you can only reply with a JSON object in the form {{"scores": [{{"id": CANDIDATE_ID, "score": number between 0 to 100}}]}} containing exactly one entry per candidate'
+
+
+def build_candidate_data(row: Row[Any], genai_model: GenAIModel) -> str:
+    return build_candidate_prompt(
+        genai_model,
+        resume=row.candidate_resume_data,
+        linkedin=row.candidate_linkedin_data,
+        github=row.candidate_github_data,
+        portfolio=row.candidate_portfolio_data,
+    )
+
+
+def compute_input_hash(system_instruction: str, candidate_data: str) -> str:
+    # the system instruction carries the agent and job inputs, the candidate data carries the four data columns
+    digest = hashlib.sha256()
+    digest.update(system_instruction.encode())
+    digest.update(b"\x00")
+    digest.update(candidate_data.encode())
+    return digest.hexdigest()
+
+
+def build_batches(pending: list[PendingScore], system_instruction: str) -> list[list[PendingScore]]:
+    # greedy packing in input order, a candidate larger than the budget still gets a batch of its own
+    budget = SCORING_BATCH_TOKEN_BUDGET - estimate_tokens(system_instruction)
+    batches: list[list[PendingScore]] = []
+    batch: list[PendingScore] = []
+    batch_tokens = 0
+
+    for item in pending:
+        tokens = estimate_tokens(item.candidate_data)
+
+        if batch and (batch_tokens + tokens > budget or len(batch) >= SCORING_BATCH_MAX_SIZE):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+
+        batch.append(item)
+        batch_tokens += tokens
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def for_row(call: LLMCallContext | None, item: PendingScore) -> LLMCallContext | None:
+    return call._replace(candidate_id=item.row.candidate_id) if call is not None else None
+
+
+@timed_stage("scoring.candidate")
+async def score_candidate(
+    genai_model: GenAIModel,
+    system_instruction: str,
+    candidate_data: str,
+    call: LLMCallContext | None = None,
+) -> int | None:
+    # None is the unscored state, returned for failed, unparsable and timed-out calls
+    async with SCORING_SEMAPHORES[get_provider(genai_model)]:
+        try:
+            async with asyncio.timeout(SCORING_TIMEOUT):
+                # no failover, a saved score is attributed to the model that was asked for
+                reply = await generate(
+                    genai_model,
+                    system_instruction,
+                    candidate_data,
+                    LLMOutput.SCORE,
+                    failover=False,
+                    call=call,
+                )
+        except Exception:
+            logger.exception("Failed to score candidate with %s", genai_model)
+            return None
+
+    if reply.text:
+        with suppress(ValueError):
+            return int(reply.text)
+
+    return None
+
+
+@timed_stage("scoring.batch")
+async def score_batch(
+    genai_model: GenAIModel,
+    system_instruction: str,
+    batch_instruction: str,
+    batch: list[PendingScore],
+    call: LLMCallContext | None = None,
+) -> list[tuple[PendingScore, int | None]]:
+    if len(batch) == 1:
+        item = batch[0]
+        return [
+            (item, await score_candidate(genai_model, system_instruction, item.candidate_data, for_row(call, item))),
+        ]
+
+    content = "\n\n\n\n".join(f"**CANDIDATE_ID:** {item.row.id}\n\n{item.candidate_data}" for item in batch)
+    batch_scores: dict[int, int] = {}
+
+    async with SCORING_SEMAPHORES[get_provider(genai_model)]:
+        try:
+            async with asyncio.timeout(SCORING_BATCH_TIMEOUT):
+                reply = await generate(
+                    genai_model,
+                    batch_instruction,
+                    content,
+                    LLMOutput.SCORES,
+                    failover=False,
+                    call=call._replace(purpose=LLMPurpose.SCORE_BATCH) if call is not None else None,
+                )
+        except Exception:
+            logger.exception("Failed to score a batch of %d candidates with %s", len(batch), genai_model)
+            reply = None
+
+    if reply is not None and reply.text:
+        with suppress(msgspec.ValidationError, msgspec.DecodeError):
+            response = msgspec.json.decode(reply.text, type=CandidateScores)
+            batch_scores = {candidate_score.id: candidate_score.score for candidate_score in response.scores}
+
+    # candidates missing from an unparsable or incomplete reply are retried one by one
+    retry = [item for item in batch if item.row.id not in batch_scores]
+    retry_scores = await asyncio.gather(
+        *(score_candidate(genai_model, system_instruction, item.candidate_data, for_row(call, item)) for item in retry),
+    )
+    batch_scores.update(
+        {item.row.id: score for item, score in zip(retry, retry_scores, strict=True) if score is not None},
+    )
+
+    return [(item, batch_scores.get(item.row.id)) for item in batch]
+
+
+def failure_retry_cutoff() -> datetime:
+    return datetime.now(UTC) - timedelta(seconds=SCORING_FAILURE_RETRY_AFTER)
+
+
+def read_score_status(row: Row[Any], retry_cutoff: datetime, inputs_updated_at: datetime) -> tuple[ScoreStatus, bool]:
+    # the status of a build_ranking_read_query row and whether the worker should be nudged to score it,
+    # inputs_updated_at is the later of the job and agent updated_at
+    if row.scored_at is not None and row.scored_at < max(inputs_updated_at, row.candidate_updated_at):
+        # the job, agent or candidate changed after the inputs of this score were read, the worker compares the
+        # input hash and rescores or revalidates it, which also catches an edit whose precompute was deduplicated
+        return ScoreStatus.PENDING, row.data_processed
+    if row.score is not None:
+        return ScoreStatus.CACHED, False
+    if row.scored_at is not None:
+        # the last attempt failed, the worker is only nudged again once the failure is old enough
+        return ScoreStatus.UNSCORED, row.scored_at < retry_cutoff
+    return ScoreStatus.PENDING, row.data_processed
+
+
+async def split_cached_scores(  # noqa: PLR0913
+    db_session: AsyncSession,
+    rows: list[Row[Any]],
+    agent_id: int,
+    genai_model: GenAIModel,
+    system_instruction: str,
+    *,
+    retry_failed: bool = True,
+) -> tuple[dict[int, int], list[PendingScore]]:
+    fit_scores = await db_session.execute(
+        select(FitScore.job_application_id, FitScore.input_hash, FitScore.score, FitScore.updated_at).where(
+            FitScore.job_application_id.in_([row.id for row in rows]),
+            FitScore.agent_id == agent_id,
+            FitScore.genai_model == genai_model,
+        ),
+    )
+    cached_scores = {fit_score.job_application_id: fit_score for fit_score in fit_scores}
+
+    cached: dict[int, int] = {}
+    pending: list[PendingScore] = []
+    retry_cutoff = failure_retry_cutoff()
+
+    for row in rows:
+        candidate_data = build_candidate_data(row, genai_model)
+        input_hash = compute_input_hash(system_instruction, candidate_data)
+        fit_score = cached_scores.get(row.id)
+
+        if fit_score is not None and fit_score.input_hash == input_hash:
+            if fit_score.score is not None:
+                cached[row.id] = fit_score.score
+                continue
+            # the same input failed recently, background passes leave it until the failure is old enough
+            if not retry_failed and fit_score.updated_at > retry_cutoff:
+                continue
+
+        pending.append(PendingScore(row, candidate_data, input_hash))
+
+    record_cache("fit_score", hit=True, amount=len(cached))
+    record_cache("fit_score", hit=False, amount=len(pending))
+
+    return cached, pending
+
+
+async def score_pending(
+    genai_model: GenAIModel,
+    system_instruction: str,
+    pending: list[PendingScore],
+    batch_instruction: str | None = None,
+    call: LLMCallContext | None = None,
+) -> AsyncIterator[tuple[PendingScore, int | None]]:
+    async def score(item: PendingScore) -> list[tuple[PendingScore, int | None]]:
+        return [
+            (item, await score_candidate(genai_model, system_instruction, item.candidate_data, for_row(call, item))),
+        ]
+
+    if batch_instruction is None:
+        tasks = [asyncio.create_task(score(item)) for item in pending]
+    else:
+        tasks = [
+            asyncio.create_task(score_batch(genai_model, system_instruction, batch_instruction, batch, call))
+            for batch in build_batches(pending, batch_instruction)
+        ]
+
+    try:
+        for task in asyncio.as_completed(tasks):
+            for result in await task:
+                yield result
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def save_fit_scores(  # noqa: PLR0913
+    db_session: AsyncSession,
+    job_id: int,
+    agent_id: int,
+    genai_model: GenAIModel,
+    scored: list[tuple[PendingScore, int | None]],
+    *,
+    read_at: datetime,
+) -> None:
+    # a None score records a failed call, so reads and precompute passes back off instead of retrying it at once,
+    # read_at is taken before the job and agent were loaded so an edit made while scoring leaves the score stale
+    if not scored:
+        return
+
+    query = insert(FitScore).values(
+        [
+            {
+                "job_id": job_id,
+                "job_application_id": item.row.id,
+                "agent_id": agent_id,
+                "genai_model": genai_model,
+                "input_hash": item.input_hash,
+                "score": score,
+                "updated_at": read_at,
+            }
+            for item, score in scored
+        ],
+    )
+    query = query.on_conflict_do_update(
+        constraint="unique_fit_score",
+        set_={
+            "input_hash": query.excluded.input_hash,
+            "score": query.excluded.score,
+            "updated_at": query.excluded.updated_at,
+        },
+    )
+    await db_session.execute(query)
+
+
+async def revalidate_fit_scores(
+    db_session: AsyncSession,
+    agent_id: int,
+    genai_model: GenAIModel,
+    application_ids: list[int],
+    read_at: datetime,
+) -> None:
+    # cached scores whose input hash still matches but that are older than an edit of their job, agent or candidate,
+    # like an embedding update, are marked fresh so reads stop reporting them as pending
+    await db_session.execute(
+        update(FitScore)
+        .where(
+            FitScore.job_application_id.in_(application_ids),
+            FitScore.agent_id == agent_id,
+            FitScore.genai_model == genai_model,
+            FitScore.score.is_not(None),
+            FitScore.updated_at < read_at,
+            FitScore.job_application_id == JobApplication.id,
+            JobApplication.candidate_id == Candidate.id,
+            FitScore.job_id == Job.id,
+            FitScore.agent_id == Agent.id,
+            FitScore.updated_at < func.greatest(Job.updated_at, Agent.updated_at, Candidate.updated_at),
+        )
+        .values(updated_at=read_at)
+        .execution_options(synchronize_session=False),
+    )
+
+
+async def enqueue_precompute(
+    queue: Queue,
+    job_id: int,
+    agent_id: int | None = None,
+    genai_model: GenAIModel | None = None,
+) -> None:
+    # the key collapses repeated requests for the same job while one is still queued or running
+    await queue.enqueue(
+        "precompute_job_scores",
+        job_id=job_id,
+        agent_id=agent_id,
+        genai_model=genai_model,
+        key=f"precompute_job_scores:{job_id}:{agent_id}:{genai_model}",
+        timeout=600,
+        ttl=2000,
+    )
+
+
+async def enqueue_scored_pairs(db_session: AsyncSession, queue: Queue, condition: ColumnElement[bool]) -> None:
+    # the default agent and model are enqueued by the caller, every other pair with fit scores is rescored here
+    # so its cached scores are not served against a previous job, agent or candidate
+    pairs = await db_session.execute(
+        select(FitScore.job_id, FitScore.agent_id, FitScore.genai_model)
+        .join(Job, FitScore.job_id == Job.id)
+        .where(
+            condition,
+            or_(
+                FitScore.agent_id.is_distinct_from(Job.default_agent_id),
+                FitScore.genai_model != GenAIModel(DEFAULT_GENAI_MODEL),
+            ),
+        )
+        .distinct(),
+    )
+
+    for pair in pairs:
+        await enqueue_precompute(queue, pair.job_id, pair.agent_id, pair.genai_model)
+
+
+async def precompute_job_scores(
+    _: Context,
+    *,
+    job_id: int,
+    agent_id: int | None = None,
+    genai_model: str | None = None,
+) -> dict[str, int]:
+    GENAI_MODEL = GenAIModel(genai_model or DEFAULT_GENAI_MODEL)  # noqa: N806
+    attempted: set[str] = set()
+    counts = {"cached": 0, "scored": 0, "unscored": 0}
+
+    # later passes pick up candidates and job or agent edits committed while the previous pass was scoring
+    for _pass in range(PRECOMPUTE_MAX_PASSES):
+        read_at = datetime.now(UTC)
+        async with DB_CONFIG.get_session() as db_session:
+            job = await db_session.scalar(select(Job).where(Job.id == job_id))
+            agent = None
+            if job is not None:
+                agent = await db_session.scalar(select(Agent).where(Agent.id == (agent_id or job.default_agent_id)))
+
+        if job is None or agent is None:
+            break
+
+        system_instruction = build_system_instruction(agent, job)
+        batch_instruction = build_batch_system_instruction(agent, job)
+        query = build_ranking_query(job_id).where(Candidate.data_processed == True)
+        counts["cached"] = 0
+        after_id = 0
+        attempted_pass = False
+
+        while True:
+            async with DB_CONFIG.get_session() as db_session:
+                rows = await load_ranking_chunk(db_session, query, after_id)
+                if not rows:
+                    break
+                cached, pending = await split_cached_scores(
+                    db_session,
+                    rows,
+                    agent.id,
+                    GENAI_MODEL,
+                    system_instruction,
+                    retry_failed=False,
+                )
+                await revalidate_fit_scores(db_session, agent.id, GENAI_MODEL, list(cached), read_at)
+                await db_session.commit()
+
+            after_id = rows[-1].id
+            counts["cached"] += len(cached)
+            pending = [item for item in pending if item.input_hash not in attempted]
+            if not pending:
+                continue
+
+            attempted.update(item.input_hash for item in pending)
+            attempted_pass = True
+            scored: list[tuple[PendingScore, int | None]] = []
+
+            async for item, score in score_pending(
+                GENAI_MODEL,
+                system_instruction,
+                pending,
+                batch_instruction,
+                LLMCallContext(LLMPurpose.SCORE, job_id=job_id, agent_id=agent.id),
+            ):
+                scored.append((item, score))
+                counts["unscored" if score is None else "scored"] += 1
+
+            async with DB_CONFIG.get_session() as db_session:
+                await save_fit_scores(db_session, job_id, agent.id, GENAI_MODEL, scored, read_at=read_at)
+                await db_session.commit()
+
+        if not attempted_pass:
+            break
+
+    return counts
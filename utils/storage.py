@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import threading
+from datetime import timedelta
+from functools import cache
+
+import google.auth
+from google.auth.credentials import Credentials, Signing
+from google.auth.transport.requests import Request
+from google.cloud import storage
+
+from config import GCS_BUCKET, SIGNED_URL_EXPIRATION
+
+logger = logging.getLogger(__name__)
+
+CREDENTIALS_LOCK = threading.Lock()
+
+
+@cache
+def get_credentials() -> tuple[Credentials, str | None]:
+    return google.auth.default()
+
+
+@cache
+def get_storage_client() -> storage.Client:
+    # credentials are read once per process instead of once per call
+    credentials, project = get_credentials()
+    return storage.Client(credentials=credentials, project=project)
+
+
+def get_bucket() -> storage.Bucket:
+    return get_storage_client().bucket(GCS_BUCKET)
+
+
+async def start_storage_client(_: object) -> None:
+    # a missing credentials file fails the first storage call instead of the app startup
+    try:
+        await asyncio.to_thread(get_storage_client)
+    except Exception:
+        logger.exception("Failed to create the storage client")
+
+
+def sign_upload_urls(blob_names: list[str]) -> dict[str, str]:
+    credentials, _ = get_credentials()
+    token_kwargs = {}
+
+    # key file credentials sign locally, token based ones sign through IAM with a token that is kept until it expires
+    if not isinstance(credentials, Signing):
+        with CREDENTIALS_LOCK:
+            if not credentials.valid:
+                credentials.refresh(Request())
+        token_kwargs = {
+            "service_account_email": credentials.service_account_email,
+            "access_token": credentials.token,
+        }
+
+    bucket = get_bucket()
+    return {
+        blob_name: bucket.blob(blob_name).generate_signed_url(
+            version="v4",
+            expiration=timedelta(seconds=SIGNED_URL_EXPIRATION),
+            method="PUT",
+            **token_kwargs,
+        )
+        for blob_name in blob_names
+    }
+
+
+async def get_upload_urls(blob_names: list[str]) -> dict[str, str]:
+    # signing is synchronous, it runs in a thread so uploads do not stall the other requests
+    return await asyncio.to_thread(sign_upload_urls, blob_names)